@@ -1,20 +1,34 @@
-import json
 import os
 
+from persistence import read_sharded, read_snapshot
+
 STORAGE_FILE = "storage.json"
+SHARD_DIR = "storage_shards"
+
+# Шардированное хранилище (STORAGE_BACKEND=sharded) проверяем вместо одиночного файла
+sharded = os.path.exists(os.path.join(SHARD_DIR, "manifest.json"))
+path = SHARD_DIR if sharded else STORAGE_FILE
 
 print("🔍 Проверка хранилища данных...")
-print(f"Файл: {STORAGE_FILE}")
+print(f"{'Каталог шардов' if sharded else 'Файл'}: {path}")
 
-if os.path.exists(STORAGE_FILE):
+if os.path.exists(path):
     print("✅ Файл существует")
     
     try:
-        with open(STORAGE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            
+        if sharded:
+            data, verified = read_sharded(SHARD_DIR)
+            shard_files = [name for name in os.listdir(SHARD_DIR) if name.startswith(("games-", "users-", "outbox-"))]
+            print(f"🧩 Файлов шардов: {len(shard_files)}")
+        else:
+            data, verified = read_snapshot(STORAGE_FILE)
+        
+        print(f"🔐 Контрольная сумма: {'✅ совпадает' if verified else '— (формат json-pretty)'}")
         print(f"📊 Игр: {len(data.get('games', {}))}")
         print(f"👤 Пользователей: {len(data.get('users', {}))}")
+        outbox = data.get('outbox', {}).values()
+        print(f"📨 Сообщений в очереди: {len([m for m in outbox if m.get('status') == 'pending'])} "
+              f"(всего записей {len(outbox)})")
         
         # Показываем все игры
         print("\n🎮 Список игр:")
@@ -24,6 +38,8 @@ if os.path.exists(STORAGE_FILE):
     except Exception as e:
         print(f"❌ Ошибка чтения файла: {e}")
         
+    print("ℹ️  Перевести в читаемый вид: python persistence.py convert storage.json storage_pretty.json json-pretty")
+        
 else:
     print("❌ Файл не существует")
 
@@ -1,38 +1,194 @@
-import json
+import asyncio
+import collections
+import copy
+import hmac
+import importlib.util
+import itertools
 import os
 import uuid
 import random
+import signal
+import subprocess
+import sys
 import time
-from datetime import datetime
-from contextlib import asynccontextmanager
+import weakref
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, nullcontext
 from telegram import (
+    Bot,
+    ChatMember,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+import httpx
 import uvicorn
 import threading
 import requests
+from persistence import (
+    JsonBackend,
+    JournalBackend,
+    LazyRecords,
+    PersistenceWorker,
+    ShardedBackend,
+    SqliteBackend,
+    StripedFileLocks,
+    atomic_write,
+    drop_invalid_games,
+    dumps_compact,
+    loads,
+    migrate_json_to_sharded,
+    migrate_json_to_sqlite,
+    move_wishes_to_games,
+)
+from models import Game, Profile, User
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# webhook — FastAPI-сервер под uvicorn (по умолчанию); polling — long polling getUpdates без HTTP-сервера;
+# worker — процесс-обработчик, его запускает сам бот при WORKERS > 1
+RUN_MODE = os.getenv("RUN_MODE", "webhook")
+# Секрет передаётся в set_webhook; запросы без него в заголовке X-Telegram-Bot-Api-Secret-Token отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 PORT = int(os.environ.get("PORT", 10000))
 STORAGE_FILE = "storage.json"
 BACKUP_FILE = "storage_backup.json"
+JOURNAL_FILE = "storage.journal"
+SQLITE_FILE = "storage.db"
+SQLITE_BACKUP_FILE = "storage_backup.db"
+SHARD_DIR = "storage_shards"
+SEEN_UPDATES_FILE = "seen_updates.json"
 FAQ_CHANNEL_LINK = "https://t.me/ssr_faq"
 
 # Константы для предотвращения сна
 PING_INTERVAL = 300  # 5 минут в секундах
 
+# Отложенное сохранение: не чаще одного раза в SAVE_INTERVAL секунд (0 — сохранять сразу)
+SAVE_INTERVAL = float(os.environ.get("SAVE_INTERVAL", 2))
+# Обслуживание хранилища (свёртка журнала, бэкапы, чистка changes) — раз в MAINTENANCE_INTERVAL секунд,
+# независимо от того, есть ли несохранённые изменения
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", 30))
+
+# Формат хранения: json — один файл целиком, journal — снапшот + журнал изменений,
+# sqlite — таблицы в storage.db, sharded — SHARD_COUNT файлов в storage_shards/
+# (для sqlite и sharded при первом запуске переносится storage.json)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 16))
+JOURNAL_COMPACT_INTERVAL = float(os.environ.get("JOURNAL_COMPACT_INTERVAL", 3600))
+JOURNAL_COMPACT_BYTES = int(os.environ.get("JOURNAL_COMPACT_BYTES", 4 * 1024 * 1024))
+
+# Формат снапшота: json-pretty (читаемый), json (минифицированный), msgpack
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "json-pretty")
+
+# Фоновая очистка завершённых игр: не больше CLEANUP_BATCH игр раз в CLEANUP_INTERVAL секунд
+CLEANUP_INTERVAL = float(os.environ.get("CLEANUP_INTERVAL", 30))
+CLEANUP_BATCH = int(os.environ.get("CLEANUP_BATCH", 20))
+
+# Бэкапы: сколько старых поколений хранить и как часто их сдвигать
+BACKUP_GENERATIONS = int(os.environ.get("BACKUP_GENERATIONS", 5))
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", 3600))
+
+# Параллельная обработка: обновления разных пользователей выполняются одновременно
+# (не больше MAX_CONCURRENT_UPDATES), обновления одного пользователя — строго по порядку
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64))
+
+# Вебхук отвечает сразу, обновления ждут обработки в очереди на UPDATE_QUEUE_SIZE мест,
+# которую разбирают UPDATE_WORKERS задач. UPDATE_SHED_POLICY — что делать при заполненной
+# очереди: reject (503, Telegram повторит), drop_new или drop_oldest.
+# При остановке принятые обновления дообрабатываются не дольше UPDATE_DRAIN_TIMEOUT секунд
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", MAX_CONCURRENT_UPDATES))
+UPDATE_SHED_POLICY = os.getenv("UPDATE_SHED_POLICY", "reject")
+UPDATE_DRAIN_TIMEOUT = float(os.environ.get("UPDATE_DRAIN_TIMEOUT", 10))
+
+# RUN_MODE=polling: getUpdates забирает до POLLING_BATCH обновлений и ждёт новых до POLLING_TIMEOUT секунд
+POLLING_BATCH = int(os.environ.get("POLLING_BATCH", 100))
+POLLING_TIMEOUT = int(os.environ.get("POLLING_TIMEOUT", 30))
+POLLING_RETRY_DELAY = 3
+
+# Несколько процессов (только webhook и STORAGE_BACKEND=sqlite): при WORKERS > 1 процесс на PORT лишь
+# принимает вебхук и пересылает обновление одному из WORKERS обработчиков по id пользователя — диалог
+# и порядок обновлений пользователя живут в одном процессе. Обработчики делят базу: общие записи меняются
+# под межпроцессными блокировками (LOCK_STRIPES файлов в LOCK_DIR) и сразу пишутся на диск, а чужие
+# изменения процесс узнаёт из таблицы changes раз в CHANGES_POLL_INTERVAL секунд
+WORKERS = int(os.environ.get("WORKERS", 1))
+WORKER_SLOT = int(os.environ.get("WORKER_SLOT", 0))
+WORKER_SOCKET_DIR = "workers"
+WORKER_RESTART_DELAY = 1
+LOCK_DIR = "locks"
+LOCK_STRIPES = int(os.environ.get("LOCK_STRIPES", 256))
+CHANGES_POLL_INTERVAL = float(os.environ.get("CHANGES_POLL_INTERVAL", 0.5))
+SHARED_STORAGE = RUN_MODE == "worker" or (RUN_MODE == "webhook" and WORKERS > 1 and STORAGE_BACKEND == "sqlite")
+
+# Повторно доставленное обновление (тот же update_id) пропускается; помним не больше
+# SEEN_UPDATES_SIZE последних update_id и не дольше SEEN_UPDATES_WINDOW секунд
+SEEN_UPDATES_SIZE = int(os.environ.get("SEEN_UPDATES_SIZE", 10000))
+SEEN_UPDATES_WINDOW = float(os.environ.get("SEEN_UPDATES_WINDOW", 24 * 3600))
+
+# Все исходящие запросы идут через SendScheduler: всего не больше SEND_RATE сообщений в секунду,
+# в один личный чат — CHAT_SEND_RATE в секунду (подряд до CHAT_SEND_BURST), в группу — GROUP_SEND_RATE.
+# После RetryAfter запрос повторяется не больше SEND_MAX_RETRIES раз
+SEND_RATE = float(os.environ.get("SEND_RATE", 25))
+CHAT_SEND_RATE = float(os.environ.get("CHAT_SEND_RATE", 1))
+CHAT_SEND_BURST = int(os.environ.get("CHAT_SEND_BURST", 3))
+GROUP_SEND_RATE = 20 / 60
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", 2))
+
+# Пул HTTP-соединений к Bot API, общий для всех запросов (getUpdates занимает одно соединение):
+# BOT_POOL_SIZE соединений, простаивающее живёт BOT_KEEPALIVE секунд, запрос ждёт свободное
+# не больше BOT_POOL_TIMEOUT секунд. BOT_HTTP_VERSION=2 — HTTP/2 (нужен пакет h2)
+BOT_POOL_SIZE = int(os.environ.get("BOT_POOL_SIZE", 32))
+BOT_KEEPALIVE = float(os.environ.get("BOT_KEEPALIVE", 30))
+BOT_POOL_TIMEOUT = float(os.environ.get("BOT_POOL_TIMEOUT", 5))
+BOT_HTTP_VERSION = os.getenv("BOT_HTTP_VERSION", "1.1")
+
+# Рассылка при распределении: не больше DRAW_CONCURRENCY запросов одновременно
+DRAW_CONCURRENCY = int(os.environ.get("DRAW_CONCURRENCY", 10))
+DRAW_PROGRESS_INTERVAL = 2.0
+
+# Очередь исходящих сообщений: после ошибки повтор через OUTBOX_RETRY_BASE * 2^попытка секунд
+# (не больше OUTBOX_MAX_BACKOFF), после OUTBOX_MAX_ATTEMPTS попыток сообщение считается недоставленным.
+# Отправленные и недоставленные записи хранятся OUTBOX_RETENTION секунд
+OUTBOX_RETRY_BASE = float(os.environ.get("OUTBOX_RETRY_BASE", 5))
+OUTBOX_MAX_BACKOFF = float(os.environ.get("OUTBOX_MAX_BACKOFF", 600))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_RETENTION = float(os.environ.get("OUTBOX_RETENTION", 24 * 3600))
+
+# Кэш профилей (bot.get_chat): запись живёт PROFILE_CACHE_TTL секунд, всего не больше PROFILE_CACHE_SIZE
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", 3600))
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 10000))
+
+# Снимок профиля в записи пользователя переписывается, когда меняется имя/username,
+# и не чаще раза в PROFILE_SEEN_RESOLUTION секунд ради отметки «был в сети»
+PROFILE_SEEN_RESOLUTION = 24 * 3600
+
+# Пользователь, заблокировавший бота или удаливший аккаунт, считается недоступным UNREACHABLE_TTL секунд:
+# сообщения и get_chat для него пропускаются без запроса к Telegram. Любое его обновление снимает отметку
+UNREACHABLE_TTL = float(os.environ.get("UNREACHABLE_TTL", 7 * 24 * 3600))
+
+# Незавершённый диалог (ожидание названия, суммы, пожеланий) забывается через CONVERSATION_TTL секунд
+CONVERSATION_TTL = float(os.environ.get("CONVERSATION_TTL", 6 * 3600))
+
+# Ленивая загрузка (только sqlite): в памяти держим не больше STORAGE_CACHE_SIZE
+# недавно использованных игр и столько же пользователей (0 — загружать всё).
+# Процессы над общей базой загружают записи всегда лениво
+STORAGE_CACHE_SIZE = int(os.environ.get("STORAGE_CACHE_SIZE", 10000 if SHARED_STORAGE else 0))
+
 EMOJI = {
     "santa": "🎅",
     "gift": "🎁",
@@ -62,7 +218,8 @@ EMOJI = {
     "wish": "🎯",
     "not_wish": "🙅",
     "preferences": "📝",
-    "help": "❓"
+    "help": "❓",
+    "blocked": "🚫"
 }
 
 def escape_markdown(text):
@@ -85,25 +242,115 @@ def get_user_html_mention(user_id, user_info):
         name = "Анонимный Санта"
     return f'<a href="tg://user?id={user_id}">{name}</a>'
 
-def create_backup():
-    try:
-        if os.path.exists(STORAGE_FILE):
-            with open(STORAGE_FILE, "r", encoding="utf-8") as src:
-                data = src.read()
-            with open(BACKUP_FILE, "w", encoding="utf-8") as dst:
-                dst.write(data)
-            return True
-    except Exception as e:
-        print(f"Ошибка создания бэкапа: {e}")
-    return False
+def create_backend():
+    backup_options = {"backup_generations": BACKUP_GENERATIONS, "backup_interval": BACKUP_INTERVAL}
+    if STORAGE_BACKEND == "sqlite":
+        if not os.path.exists(SQLITE_FILE) and os.path.exists(STORAGE_FILE):
+            print(f"📦 Переносим {STORAGE_FILE} в {SQLITE_FILE}...")
+            migrate_json_to_sqlite(STORAGE_FILE, SQLITE_FILE)
+        # Обработчик отмечает свои записи в changes, чтобы остальные процессы забыли их старые копии
+        origin = f"worker-{WORKER_SLOT}" if RUN_MODE == "worker" else None
+        return SqliteBackend(SQLITE_FILE, SQLITE_BACKUP_FILE, origin=origin, **backup_options)
+    if STORAGE_BACKEND == "sharded":
+        if not os.path.exists(os.path.join(SHARD_DIR, "manifest.json")) and os.path.exists(STORAGE_FILE):
+            print(f"📦 Раскладываем {STORAGE_FILE} по шардам в {SHARD_DIR}...")
+            migrate_json_to_sharded(STORAGE_FILE, SHARD_DIR, SHARD_COUNT)
+        return ShardedBackend(
+            SHARD_DIR,
+            BACKUP_FILE,
+            shard_count=SHARD_COUNT,
+            snapshot_format=SNAPSHOT_FORMAT,
+            **backup_options,
+        )
+    if STORAGE_BACKEND == "journal":
+        return JournalBackend(
+            STORAGE_FILE,
+            BACKUP_FILE,
+            JOURNAL_FILE,
+            compact_bytes=JOURNAL_COMPACT_BYTES,
+            compact_interval=JOURNAL_COMPACT_INTERVAL,
+            snapshot_format=SNAPSHOT_FORMAT,
+            **backup_options,
+        )
+    return JsonBackend(STORAGE_FILE, BACKUP_FILE, snapshot_format=SNAPSHOT_FORMAT, **backup_options)
+
+backend = create_backend()
+
+def create_backup(rotate=False):
+    """Бэкап делается в потоке сохранения после уже поставленных записей; возвращает Future"""
+    def backup():
+        try:
+            return backend.backup(rotate=rotate)
+        except Exception as e:
+            print(f"Ошибка создания бэкапа: {e}")
+        return False
+    return persistence_worker.call(backup)
+
+# Записи, изменённые миграциями при загрузке: первая же пачка перепишет их на диске
+migrated_games = set()
+migrated_users = set()
+
+CONVERSATION_FIELDS = ("state", "tmp_name", "tmp_game_id")
+
+def drop_conversation_fields(data):
+    """Состояние диалога раньше хранилось в users; теперь оно только в памяти"""
+    dropped = 0
+    for user in data["users"].values():
+        if isinstance(user, dict):
+            for field in CONVERSATION_FIELDS:
+                if user.pop(field, None) is not None:
+                    dropped += 1
+    if dropped:
+        print(f"🧹 Удалено устаревших полей диалога: {dropped}")
+    return data
+
+def build_models(data):
+    """Словари записей с диска превращаются в объекты Game/User (id пользователей — int)"""
+    data["games"] = {game_id: Game.from_dict(game) for game_id, game in data["games"].items()}
+    data["users"] = {int(uid): User.from_dict(uid, user) for uid, user in data["users"].items()}
+    return data
+
+def prepare_storage(data):
+    """Разовые миграции загруженных данных; дальше бот работает только с моделью"""
+    games, users = move_wishes_to_games(data)
+    migrated_games.update(games)
+    migrated_users.update(users)
+    drop_conversation_fields(data)
+    return build_models(data)
+
+def load_game_record(game_id):
+    data = backend.load_game(game_id)
+    return Game.from_dict(data) if data else None
+
+def load_user_record(uid):
+    data = backend.load_user(str(uid))
+    return User.from_dict(uid, data) if data else None
+
+def load_lazy_storage():
+    """Записи подгружаются из SQLite по требованию, в памяти — только горячие"""
+    meta = backend.load_meta() or {"last_save": time.time(), "version": "1.0"}
+    data = {
+        "games": LazyRecords(load_game_record, lambda: backend.count("games"), STORAGE_CACHE_SIZE),
+        "users": LazyRecords(load_user_record, lambda: backend.count("users"), STORAGE_CACHE_SIZE),
+        # Каждый обработчик отправляет только свои сообщения
+        "outbox": backend.load_outbox(WORKER_SLOT if RUN_MODE == "worker" else None),
+        "_metadata": meta,
+    }
+    print(f"✅ Ленивая загрузка: {len(data['games'])} игр, {len(data['users'])} пользователей на диске, "
+          f"в памяти до {STORAGE_CACHE_SIZE} записей каждого типа")
+    return data
 
 def load_storage():
-    default_data = {"games": {}, "users": {}, "_metadata": {"last_save": time.time(), "version": "1.0"}}
+    default_data = {"games": {}, "users": {}, "outbox": {}, "_metadata": {"last_save": time.time(), "version": "1.0"}}
     
-    if os.path.exists(STORAGE_FILE):
+    if STORAGE_CACHE_SIZE > 0 or SHARED_STORAGE:
+        if backend.name == "sqlite":
+            return load_lazy_storage()
+        print("⚠️  STORAGE_CACHE_SIZE работает только с STORAGE_BACKEND=sqlite, загружаем всё")
+    
+    if backend.exists():
         try:
-            with open(STORAGE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            data = backend.load()
             
             if not isinstance(data, dict):
                 print("❌ Неверный формат данных, загружаем бэкап")
@@ -113,26 +360,21 @@ def load_storage():
                 data["games"] = {}
             if "users" not in data:
                 data["users"] = {}
+            if "outbox" not in data:
+                data["outbox"] = {}
             if "_metadata" not in data:
                 data["_metadata"] = {"last_save": time.time(), "version": "1.0"}
             
-            games_to_remove = []
-            for game_id, game in data["games"].items():
-                if not isinstance(game, dict):
-                    games_to_remove.append(game_id)
-                elif "players" not in game:
-                    games_to_remove.append(game_id)
-            
-            for game_id in games_to_remove:
-                print(f"❌ Удаляем некорректную игру: {game_id}")
-                if game_id in data["games"]:
-                    del data["games"][game_id]
+            # Снапшот с верной контрольной суммой записан нами же — проверять игры не нужно
+            if not backend.verified:
+                drop_invalid_games(data)
             
+            prepare_storage(data)
             print(f"✅ Данные загружены: {len(data['games'])} игр, {len(data['users'])} пользователей")
             return data
             
-        except json.JSONDecodeError as e:
-            print(f"❌ Ошибка чтения JSON: {e}")
+        except ValueError as e:
+            print(f"❌ Ошибка чтения данных: {e}")
             return load_backup_or_default(default_data)
         except Exception as e:
             print(f"❌ Ошибка загрузки данных: {e}")
@@ -143,9 +385,8 @@ def load_storage():
 
 def load_backup_or_default(default_data):
     try:
-        if os.path.exists(BACKUP_FILE):
-            with open(BACKUP_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+        data = backend.load_backup()
+        if data is not None:
             print("✅ Данные восстановлены из бэкапа")
             
             if not isinstance(data, dict):
@@ -154,102 +395,1283 @@ def load_backup_or_default(default_data):
                 data["games"] = {}
             if "users" not in data:
                 data["users"] = {}
+            if "outbox" not in data:
+                data["outbox"] = {}
             if "_metadata" not in data:
                 data["_metadata"] = {"last_save": time.time(), "version": "1.0"}
             
-            return data
+            return prepare_storage(data)
     except Exception as e:
         print(f"❌ Ошибка загрузки бэкапа: {e}")
     
     return default_data
 
-def save_storage():
-    try:
-        if "_metadata" not in storage:
-            storage["_metadata"] = {}
-        storage["_metadata"]["last_save"] = time.time()
-        storage["_metadata"]["version"] = "1.0"
+def save_storage(batch):
+    """Отдаёт пачку изменений потоку сохранения; возвращает Future"""
+    if "_metadata" not in storage:
+        storage["_metadata"] = {}
+    storage["_metadata"]["last_save"] = time.time()
+    storage["_metadata"]["version"] = "1.0"
+    if is_lazy_storage():
+        # len() ленивых записей — COUNT(*) по таблице; счётчики для статистики считает storage_counts()
+        storage["_metadata"].pop("games_count", None)
+        storage["_metadata"].pop("users_count", None)
+    else:
         storage["_metadata"]["games_count"] = len(storage["games"])
         storage["_metadata"]["users_count"] = len(storage["users"])
-        
-        create_backup()
-        
-        with open(STORAGE_FILE, "w", encoding="utf-8") as f:
-            json.dump(storage, f, ensure_ascii=False, indent=2, default=str)
-        
-        print(f"💾 Данные сохранены: {len(storage['games'])} игр, {len(storage['users'])} пользователей")
-        return True
-    except Exception as e:
-        print(f"❌ Ошибка сохранения данных: {e}")
-        return False
+    batch["meta"] = dict(storage["_metadata"])
+    
+    future = persistence_worker.submit(batch)
+    future.batch = batch
+    future.add_done_callback(on_batch_saved)
+    loop = asyncio.get_running_loop()
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(on_batch_written, f))
+    return future
+
+def on_batch_written(future):
+    """В event loop: записанные на диск записи снова можно вытеснять из памяти,
+    а сообщения из пачки — отправлять"""
+    if future.exception() is not None:
+        return
+    if is_lazy_storage():
+        unpin_batch(future.batch)
+    release_saved_messages(future.batch["outbox"])
+
+def on_batch_saved(future):
+    """Вызывается в потоке сохранения после записи пачки"""
+    error = future.exception()
+    if error is None:
+        batch = future.result()
+        meta = batch["meta"]
+        if "games_count" in meta:
+            print(f"💾 Данные сохранены: {meta['games_count']} игр, {meta['users_count']} пользователей")
+        else:
+            print(f"💾 Данные сохранены: изменено {len(batch['games'])} игр, {len(batch['users'])} пользователей")
+        return
+    print(f"❌ Ошибка сохранения данных: {error}")
+    failed_batches.append(future.batch)
 
 storage = load_storage()
 
+def storage_size():
+    """Размер данных на диске в байтах (для каталога шардов — сумма файлов)"""
+    if not os.path.exists(backend.path):
+        return 0
+    if os.path.isdir(backend.path):
+        return sum(entry.stat().st_size for entry in os.scandir(backend.path) if entry.is_file())
+    return os.path.getsize(backend.path)
+
+def is_lazy_storage():
+    return isinstance(storage["games"], LazyRecords)
+
+def storage_counts():
+    """Счётчики для статистики; в ленивом режиме — запросом к базе, без обхода записей"""
+    if is_lazy_storage():
+        return backend.counts()
+    games = storage["games"].values()
+    return {
+        "games": len(storage["games"]),
+        "active_games": len([g for g in games if not g.started]),
+        "finished_games": len([g for g in games if g.started]),
+        "users": len(storage["users"]),
+        "users_with_games": len([u for u in storage["users"].values() if u.games]),
+    }
+
+def cache_stats():
+    if not is_lazy_storage():
+        return None
+    return {"games": storage["games"].stats(), "users": storage["users"].stats()}
+
+def storage_snapshot():
+    """Все записи в формате файла данных — для копии в потоке сохранения"""
+    return {
+        "games": {game_id: game.to_dict() for game_id, game in storage["games"].items()},
+        "users": {str(uid): user.to_dict() for uid, user in storage["users"].items()},
+        "outbox": {message_id: dict(message) for message_id, message in storage["outbox"].items()},
+        "_metadata": copy.deepcopy(storage["_metadata"]),
+    }
+
+persistence_worker = PersistenceWorker(backend, storage_snapshot() if backend.needs_mirror else None)
+failed_batches = collections.deque()
+
 def gen_game_id():
     return str(uuid.uuid4())[:8]
 
 def get_user(uid):
-    uid_str = str(uid)
-    if uid_str not in storage["users"]:
-        storage["users"][uid_str] = {
-            "state": None,
-            "games": [],
-            "wishes": {},
-            "preferences": {}
-        }
-    
-    user = storage["users"][uid_str]
-    if "state" not in user:
-        user["state"] = None
-    if "games" not in user:
-        user["games"] = []
-    if "wishes" not in user:
-        user["wishes"] = {}
-    if "preferences" not in user:
-        user["preferences"] = {}
-    
+    user = storage["users"].get(uid)
+    if user is None:
+        user = storage["users"][uid] = User(uid)
     return user
 
-def safe_save():
+class ConversationStore:
+    """Состояние диалога пользователя — только в памяти, на диск не пишется.
+
+    Запись живёт ttl секунд с последнего обращения; после перезапуска
+    незаконченный диалог начинается заново из меню.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.items = {}
+
+    def get(self, uid):
+        """Словарь диалога ({"state": ..., "tmp_name": ...}); продлевает TTL"""
+        uid = str(uid)
+        item = self.items.get(uid)
+        now = time.monotonic()
+        if item is None or item[0] < now:
+            item = self.items[uid] = [0, {"state": None}]
+        item[0] = now + self.ttl
+        return item[1]
+
+    def clear(self, uid):
+        self.items.pop(str(uid), None)
+
+    def expire(self):
+        now = time.monotonic()
+        expired = [uid for uid, (deadline, _) in self.items.items() if deadline < now]
+        for uid in expired:
+            del self.items[uid]
+        return len(expired)
+
+    def __len__(self):
+        return len(self.items)
+
+conversations = ConversationStore(CONVERSATION_TTL)
+
+def get_wishes(game, uid):
+    """Пожелания участника хранятся в самой игре, поэтому удаляются вместе с ней"""
+    return game.wishes.get(uid, {})
+
+def has_wishes(game, uid):
+    wishes = get_wishes(game, uid)
+    return bool(wishes.get("wish") or wishes.get("not_wish"))
+
+def set_wish(game, uid, key, text):
+    game.wishes.setdefault(uid, {})[key] = text
+
+def remove_player(game, uid):
+    """Убирает участника из игры и игру из его списка"""
+    game.players.discard(uid)
+    game.wishes.pop(uid, None)
+    user = storage["users"].get(uid)
+    if user:
+        user.games.discard(game.id)
+
+storage_dirty = False
+dirty_games = set()
+dirty_users = set()
+dirty_outbox = set()
+dirty_ops = []
+
+def mark_dirty(op=None, games=(), users=(), outbox=()):
+    global storage_dirty
+    storage_dirty = True
+    if op and op not in dirty_ops:
+        dirty_ops.append(op)
+    users = {int(uid) for uid in users}
+    if is_lazy_storage():
+        # Несохранённые записи нельзя вытеснять: с диска прочиталась бы старая версия
+        for game_id in set(games) - dirty_games:
+            storage["games"].pin(game_id)
+        for uid in users - dirty_users:
+            storage["users"].pin(uid)
+    dirty_games.update(games)
+    dirty_users.update(users)
+    dirty_outbox.update(outbox)
+
+if migrated_games or migrated_users:
+    # Журнал и шарды переписывают записи по одной: без этого пользователь сохранился бы
+    # без пожеланий, а игра на диске так и осталась бы без них
+    mark_dirty("migrate", games=migrated_games, users=migrated_users)
+
+def unpin_batch(batch):
+    for game_id in batch["games"]:
+        storage["games"].unpin(game_id)
+    for uid in batch["users"]:
+        storage["users"].unpin(int(uid))
+
+def collect_batch():
+    """Забирает накопленные изменения: словари записей или None для удалённых.
+
+    Сериализуются только изменённые записи, поэтому цена снапшота не зависит
+    от размера базы.
+    """
+    games = {game_id: storage["games"].get(game_id) for game_id in dirty_games}
+    users = {uid: storage["users"].get(uid) for uid in dirty_users}
+    batch = {
+        "ops": dirty_ops[:],
+        "games": {game_id: game and game.to_dict() for game_id, game in games.items()},
+        "users": {str(uid): user and user.to_dict() for uid, user in users.items()},
+        "outbox": {message_id: copy.copy(storage["outbox"].get(message_id)) for message_id in dirty_outbox},
+    }
+    dirty_ops.clear()
+    dirty_games.clear()
+    dirty_users.clear()
+    dirty_outbox.clear()
+    return batch
+
+def flush_storage():
+    """Отдаёт несохранённые изменения потоку сохранения, не дожидаясь записи.
+
+    Возвращает concurrent.futures.Future; дождаться записи — flush_and_wait().
+    """
+    global storage_dirty
+    if not storage_dirty:
+        return persistence_worker.call(lambda: None)
+    storage_dirty = False
+    batch = collect_batch()
+    return save_storage(batch)
+
+async def flush_and_wait():
+    """Для критичных переходов: ждёт, пока изменения окажутся на диске"""
     try:
-        return save_storage()
+        await asyncio.wrap_future(flush_storage())
+        return True
     except Exception as e:
         print(f"❌ Критическая ошибка сохранения: {e}")
         return False
 
-def cleanup_finished_games():
-    games_to_remove = []
+def requeue_failed_batches():
+    while failed_batches:
+        batch = failed_batches.popleft()
+        mark_dirty(games=batch["games"], users=batch["users"], outbox=batch["outbox"])
+        dirty_ops[:0] = batch["ops"]
+        if is_lazy_storage():
+            unpin_batch(batch)
+
+def safe_save(op=None, games=(), users=(), immediate=False, outbox=()):
+    """Помечает изменённые записи; запись выполнит autosave_loop.
+
+    op — название изменения для журнала, games/users/outbox — затронутые id.
+    immediate=True (или SAVE_INTERVAL=0) — отдать на запись прямо сейчас.
+    С общей базой запись всегда немедленная: другие процессы читают её с диска.
+    """
+    mark_dirty(op, games, users, outbox)
+    if immediate or SAVE_INTERVAL <= 0 or SHARED_STORAGE:
+        flush_storage()
+    return True
+
+def storage_maintenance():
+    # Бэкапы общей базы и чистку changes делает один обработчик
+    if RUN_MODE == "worker" and WORKER_SLOT != 0:
+        return
+    def on_done(future):
+        if future.exception():
+            print(f"❌ Ошибка обслуживания хранилища: {future.exception()}")
+    persistence_worker.maintenance().add_done_callback(on_done)
+
+async def autosave_loop():
+    """Фоновая запись изменений не чаще одного раза в SAVE_INTERVAL секунд и обслуживание бэкенда"""
+    last_maintenance = time.monotonic()
+    while True:
+        await asyncio.sleep(min(SAVE_INTERVAL if SAVE_INTERVAL > 0 else 60, MAINTENANCE_INTERVAL))
+        requeue_failed_batches()
+        if storage_dirty:
+            flush_storage()
+        # На нагруженном боте грязно почти всегда: обслуживание идёт по своему расписанию,
+        # в потоке сохранения — после только что поставленной пачки
+        if time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL:
+            last_maintenance = time.monotonic()
+            storage_maintenance()
+        if seen_updates.dirty:
+            seen_updates.save()
+        if is_lazy_storage():
+            storage["games"].trim()
+            storage["users"].trim()
+
+finished_games = collections.deque()
+
+def remove_game(game_id):
+    """Удаляет игру; id игры убирается только у её участников (по списку players).
+
+    Возвращает id пользователей, чьи записи изменились.
+    """
+    game = storage["games"].pop(game_id, None)
+    touched_users = set()
+    if not game:
+        return touched_users
+    for uid in game.players:
+        user_data = storage["users"].get(uid)
+        if not user_data:
+            continue
+        if user_data.games.discard(game_id):
+            touched_users.add(uid)
+        if game_id in user_data.preferences:
+            del user_data.preferences[game_id]
+            touched_users.add(uid)
+    return touched_users
+
+def queue_started_games():
+    """Ставит в очередь очистки игры, распределение в которых уже проведено"""
+    if is_lazy_storage():
+        finished_games.extend(backend.started_game_ids())
+        return len(finished_games)
     for game_id, game in storage["games"].items():
-        if game.get("started"):
-            games_to_remove.append(game_id)
-
-    removed_count = 0
-    for game_id in games_to_remove:
+        if game.started:
+            finished_games.append(game_id)
+    return len(finished_games)
+
+def cleanup_finished_games(limit=None):
+    """Удаляет из очереди не больше limit завершённых игр"""
+    removed = []
+    touched_users = set()
+    while finished_games and (limit is None or len(removed) < limit):
+        game_id = finished_games.popleft()
+        game = storage["games"].get(game_id)
+        if not game or not game.started:
+            continue
         try:
-            for uid, user_data in storage["users"].items():
-                if "games" in user_data and game_id in user_data["games"]:
-                    user_data["games"].remove(game_id)
-                
-                if "wishes" in user_data and game_id in user_data["wishes"]:
-                    del user_data["wishes"][game_id]
-                
-                if "preferences" in user_data and game_id in user_data["preferences"]:
-                    del user_data["preferences"][game_id]
-
-            if game_id in storage["games"]:
-                del storage["games"][game_id]
-                removed_count += 1
-                
+            touched_users |= remove_game(game_id)
+            removed.append(game_id)
         except Exception as e:
             print(f"❌ Ошибка при удалении игры {game_id}: {e}")
 
-    if removed_count > 0:
-        if safe_save():
-            print(f"✅ Удалено завершенных игр: {removed_count}")
+    if removed:
+        if safe_save("cleanup", games=removed, users=touched_users):
+            print(f"✅ Удалено завершенных игр: {len(removed)}")
         else:
             print(f"❌ Ошибка сохранения после удаления игр")
     
-    return removed_count
+    return len(removed)
+
+async def cleanup_shared_games(limit):
+    """cleanup_finished_games для общей базы: игра и записи её участников меняются под блокировками"""
+    removed = 0
+    while finished_games and removed < limit:
+        game_id = finished_games.popleft()
+        async with game_lock(game_id):
+            game = storage["games"].get(game_id)
+            if not game or not game.started:
+                continue
+            async with users_lock(game.players):
+                touched_users = remove_game(game_id)
+                safe_save("cleanup", games=[game_id], users=touched_users)
+            removed += 1
+    if removed:
+        print(f"✅ Удалено завершенных игр: {removed}")
+    return removed
+
+async def cleanup_loop():
+    """Очищает завершённые игры небольшими порциями в фоне"""
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        if SHARED_STORAGE:
+            await cleanup_shared_games(CLEANUP_BATCH)
+        else:
+            cleanup_finished_games(limit=CLEANUP_BATCH)
+        purge_outbox()
+        conversations.expire()
+
+# ========== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ==========
+
+def update_owner(update):
+    """Чьё обновление: id пользователя, иначе чата; None — порядок обработки не важен"""
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно, одного — по очереди.
+
+    asyncio.Lock отдаёт управление в порядке ожидания, поэтому обновления
+    пользователя выполняются в порядке поступления. Ожидающее обновление
+    занимает место в лимите max_concurrent_updates, поэтому UpdateQueue
+    не отдаёт сюда следующее обновление пользователя, пока не закончено
+    предыдущее; блокировка остаётся для обновлений, пришедших в обход очереди.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update, coroutine):
+        key = update_owner(update)
+        if key is None:
+            await coroutine
+            return
+        lock = self.user_locks.get(key)
+        if lock is None:
+            lock = self.user_locks[key] = asyncio.Lock()
+        async with lock:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class UpdateQueue:
+    """Очередь входящих обновлений между /webhook и обработчиками.
+
+    Вебхук только кладёт обновление в очередь и сразу отвечает Telegram;
+    workers задач разбирают очередь через update_processor приложения.
+    Когда очередь заполнена, действует policy:
+    reject — ответить 503, Telegram повторит доставку позже (обновление не теряется);
+    drop_new — принять и выбросить новое обновление;
+    drop_oldest — выбросить самое старое из очереди и принять новое.
+
+    Обновления одного пользователя обрабатываются по очереди: если его
+    предыдущее обновление ещё выполняется, следующее откладывается в
+    цепочку пользователя, и worker берёт из очереди обновление другого.
+    Цепочку дорабатывает worker, начавший её. Отложенные обновления
+    занимают место в очереди наравне с ожидающими.
+    """
+
+    POLICIES = ("reject", "drop_new", "drop_oldest")
+
+    def __init__(self, size, workers, policy):
+        if policy not in self.POLICIES:
+            print(f"⚠️  Неизвестная политика UPDATE_SHED_POLICY={policy}, используем reject")
+            policy = "reject"
+        self.size = size
+        self.workers = workers
+        self.policy = policy
+        self.queue = None
+        self.tasks = []
+        self.application = None
+        self.accepted = 0
+        self.shed = 0
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.max_wait = 0.0
+        # {id пользователя: deque((update, queued_at))} — пользователи, чьё обновление сейчас выполняется
+        self.chains = {}
+        self.deferred = 0
+
+    def start(self, application):
+        self.application = application
+        self.queue = asyncio.Queue(self.size)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout):
+        """Даёт обработать уже принятые обновления (не дольше timeout секунд) и останавливает workers"""
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️  Не обработано обновлений при остановке: {self.queue.qsize()}")
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def put(self, update):
+        """Ставит обновление в очередь; False — очередь заполнена и Telegram нужно ответить ошибкой"""
+        item = (update, time.monotonic())
+        if self.queue.full() or self.queue.qsize() + self.deferred >= self.size:
+            self.shed += 1
+            if self.policy == "reject":
+                return False
+            if self.policy == "drop_new" or self.queue.empty():
+                print(f"⚠️  Очередь обновлений заполнена, обновление {update.update_id} отброшено")
+                return True
+            dropped, _ = self.queue.get_nowait()
+            self.queue.task_done()
+            print(f"⚠️  Очередь обновлений заполнена, отброшено старое обновление {dropped.update_id}")
+        self.queue.put_nowait(item)
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    async def put_wait(self, update):
+        """Для long polling: при заполненной очереди ждёт места вместо отказа"""
+        await self.queue.put((update, time.monotonic()))
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def worker(self):
+        while True:
+            update, queued_at = await self.queue.get()
+            key = update_owner(update)
+            if key is None:
+                await self.handle(update, queued_at)
+                continue
+            chain = self.chains.get(key)
+            if chain is not None:
+                # Ожидание своей очереди не должно занимать worker и место в лимите обработчиков
+                chain.append((update, queued_at))
+                self.deferred += 1
+                continue
+            chain = self.chains[key] = collections.deque()
+            try:
+                await self.handle(update, queued_at)
+                while chain:
+                    self.deferred -= 1
+                    await self.handle(*chain.popleft())
+            finally:
+                del self.chains[key]
+
+    async def handle(self, update, queued_at):
+        application = self.application
+        waited = time.monotonic() - queued_at
+        self.wait_total += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            await application.update_processor.process_update(update, application.process_update(update))
+            self.processed += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            self.queue.task_done()
+
+    def stats(self):
+        handled = self.processed + self.errors
+        return {
+            "depth": self.queue.qsize() if self.queue else 0,
+            "deferred": self.deferred,
+            "busy_users": len(self.chains),
+            "capacity": self.size,
+            "max_depth": self.max_depth,
+            "workers": self.workers,
+            "policy": self.policy,
+            "accepted": self.accepted,
+            "shed": self.shed,
+            "processed": self.processed,
+            "errors": self.errors,
+            "avg_wait": round(self.wait_total / handled, 4) if handled else 0.0,
+            "max_wait": round(self.max_wait, 4),
+        }
+
+update_queue = UpdateQueue(UPDATE_QUEUE_SIZE, UPDATE_WORKERS, UPDATE_SHED_POLICY)
+
+class SeenUpdates:
+    """update_id недавно принятых обновлений: повторную доставку Telegram не обрабатываем.
+
+    Хранится не больше size id и не дольше window секунд; список переживает
+    перезапуск (файл path, пишется в потоке сохранения).
+    """
+
+    def __init__(self, path, size, window):
+        self.path = path
+        self.size = size
+        self.window = window
+        self.updates = collections.OrderedDict()
+        self.duplicates = 0
+        self.dirty = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                pairs = loads(f.read())
+        except (OSError, ValueError) as e:
+            print(f"❌ Ошибка чтения {self.path}: {e}")
+            return
+        for update_id, seen_at in pairs:
+            self.updates[update_id] = seen_at
+        self.expire()
+        print(f"🔁 Загружено принятых update_id: {len(self.updates)}")
+
+    def expire(self):
+        deadline = time.time() - self.window
+        while self.updates and (len(self.updates) > self.size or next(iter(self.updates.values())) < deadline):
+            self.updates.popitem(last=False)
+
+    def is_duplicate(self, update_id):
+        if update_id in self.updates:
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, update_id):
+        self.updates[update_id] = time.time()
+        self.dirty = True
+        self.expire()
+
+    def save(self):
+        """Отдаёт список потоку сохранения; возвращает Future"""
+        self.dirty = False
+        payload = dumps_compact(list(self.updates.items())).encode("utf-8")
+        return persistence_worker.call(lambda: atomic_write(self.path, lambda f: f.write(payload)))
+
+    def stats(self):
+        return {"size": len(self.updates), "capacity": self.size, "duplicates": self.duplicates}
+
+# Обновления пользователя всегда приходят в один обработчик, поэтому списка на процесс достаточно
+seen_updates = SeenUpdates(
+    f"seen_updates-{WORKER_SLOT}.json" if RUN_MODE == "worker" else SEEN_UPDATES_FILE,
+    SEEN_UPDATES_SIZE,
+    SEEN_UPDATES_WINDOW,
+)
+seen_updates.load()
+
+game_locks = weakref.WeakValueDictionary()
+
+def game_lock(game_id):
+    """Блокировка игры для изменений, между которыми есть await.
+
+    Внутри блокировки игру нужно перечитать и заново проверить её состояние.
+    С общей базой блокировка действует и на другие процессы.
+    """
+    if SHARED_STORAGE:
+        return SharedLock("games", [game_id])
+    lock = game_locks.get(game_id)
+    if lock is None:
+        lock = game_locks[game_id] = asyncio.Lock()
+    return lock
+
+def users_lock(uids):
+    """Блокировка записей пользователей, которые меняет не только их собственное обновление
+    (вступление и удаление из игры, очистка, отметка недоступности).
+
+    В одном процессе изменение без await и так атомарно, блокировка нужна только
+    общей базе. Берётся после game_lock и не вкладывается в другую users_lock.
+    """
+    if SHARED_STORAGE:
+        return SharedLock("users", uids)
+    return nullcontext()
+
+# Полосы блокировок: между процессами — flock, между корутинами процесса — asyncio.Lock
+file_locks = StripedFileLocks(LOCK_DIR, LOCK_STRIPES) if SHARED_STORAGE else None
+stripe_locks = collections.defaultdict(asyncio.Lock)
+
+class SharedLock:
+    """Блокировка записей одной коллекции для процессов над общей базой.
+
+    Полосы захватываются по возрастанию, поэтому два набора ключей не ждут
+    друг друга по кругу. После захвата записи перечитываются с диска, перед
+    освобождением изменения дописываются на диск: следующий владелец
+    блокировки в любом процессе увидит их.
+    """
+
+    def __init__(self, collection, keys):
+        self.collection = collection
+        self.keys = [int(key) if collection == "users" else key for key in keys]
+        self.stripes = sorted({file_locks.stripe(collection, key) for key in self.keys})
+        self.held = []
+
+    async def acquire(self, stripe):
+        await stripe_locks[stripe].acquire()
+        try:
+            delay = 0.001
+            while not file_locks.try_acquire(stripe):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        except BaseException:
+            stripe_locks[stripe].release()
+            raise
+        self.held.append(stripe)
+
+    def release(self):
+        for stripe in reversed(self.held):
+            file_locks.release(stripe)
+            stripe_locks[stripe].release()
+        self.held.clear()
+
+    async def __aenter__(self):
+        try:
+            for stripe in self.stripes:
+                await self.acquire(stripe)
+        except BaseException:
+            self.release()
+            raise
+        for key in self.keys:
+            storage[self.collection].invalidate(key)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await flush_and_wait()
+        finally:
+            self.release()
+
+async def changes_loop():
+    """Забывает записи, которые изменили другие процессы: следующее обращение прочитает их с диска"""
+    seq = backend.last_change()
+    while True:
+        await asyncio.sleep(CHANGES_POLL_INTERVAL)
+        for seq, collection, key in backend.changes_since(seq):
+            storage[collection].invalidate(int(key) if collection == "users" else key)
+
+# ========== ЗАПРОСЫ К BOT API ==========
+
+class MethodStats:
+    """Счётчики одного метода Bot API; перцентили — по последним LATENCY_SAMPLES вызовам"""
+
+    LATENCY_SAMPLES = 512
+
+    __slots__ = ("calls", "errors", "retry_after", "total", "max", "samples")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = collections.Counter()
+        self.retry_after = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=self.LATENCY_SAMPLES)
+
+    def record(self, elapsed, error=None):
+        self.calls += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.samples.append(elapsed)
+        if error == 429:
+            self.retry_after += 1
+        elif error is not None:
+            self.errors[str(error)] += 1
+
+    def percentile(self, q):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": dict(self.errors),
+            "retry_after": self.retry_after,
+            "avg": round(self.total / self.calls, 4),
+            "p50": round(self.percentile(0.5), 4),
+            "p95": round(self.percentile(0.95), 4),
+            "max": round(self.max, 4),
+        }
+
+class TimedRequest(BaseRequest):
+    """Обёртка над HTTPXRequest: задержка, ошибки и ответы 429 по каждому методу Bot API.
+
+    Ошибки считаются по HTTP-коду ответа или по имени исключения (TimedOut при
+    нехватке соединений в пуле — повод увеличить BOT_POOL_SIZE).
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.methods = collections.defaultdict(MethodStats)
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        stats = self.methods[url.rsplit("/", 1)[-1]]
+        started = time.monotonic()
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            stats.record(time.monotonic() - started, type(e).__name__)
+            raise
+        stats.record(time.monotonic() - started, code if code >= 400 else None)
+        return code, payload
+
+    def stats(self):
+        return {method: stats.to_dict() for method, stats in sorted(self.methods.items())}
+
+def create_bot_request():
+    """Один пул соединений на все запросы бота, включая getUpdates"""
+    http_version = BOT_HTTP_VERSION
+    if http_version == "2" and importlib.util.find_spec("h2") is None:
+        print("⚠️  Для HTTP/2 нужен пакет h2 (pip install httpx[http2]), используем HTTP/1.1")
+        http_version = "1.1"
+    return TimedRequest(HTTPXRequest(
+        connection_pool_size=BOT_POOL_SIZE,
+        pool_timeout=BOT_POOL_TIMEOUT,
+        http_version=http_version,
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=BOT_POOL_SIZE,
+                max_keepalive_connections=BOT_POOL_SIZE,
+                keepalive_expiry=BOT_KEEPALIVE,
+            ),
+        },
+    ))
+
+# ========== РАССЫЛКА ==========
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after — int в PTB 21 и timedelta в новых версиях"""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+class TokenBucket:
+    """Ведро токенов: в среднем rate запросов в секунду, подряд — не больше burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Сколько ждать до следующего токена"""
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+    async def wait(self):
+        """Бронирует токен (баланс может уйти в минус) и ждёт своей очереди"""
+        self.take()
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def idle(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+class SendScheduler(BaseRateLimiter):
+    """Единая очередь исходящих запросов бота с лимитами Telegram.
+
+    Запрос сначала ждёт токен своего чата (личный чат — CHAT_SEND_RATE в секунду,
+    группа — GROUP_SEND_RATE), затем — общий токен (SEND_RATE в секунду). Общие токены
+    выдаются по классам приоритета: interactive (ответы на кнопки, правка сообщений),
+    default (ответы на команды и текст), bulk (рассылки из очереди сообщений).
+    Класс задаётся через rate_limit_args={"priority": ...}. RetryAfter приостанавливает
+    выдачу токенов всем, и запрос встаёт в очередь заново.
+    """
+
+    PRIORITIES = ("interactive", "default", "bulk")
+    INTERACTIVE_ENDPOINTS = {"answerCallbackQuery", "editMessageText", "editMessageReplyMarkup"}
+    # Служебные запросы не расходуют лимит сообщений
+    UNLIMITED_ENDPOINTS = {"getMe", "getChat", "setWebhook", "deleteWebhook", "getWebhookInfo", "close", "logOut"}
+    CHAT_BUCKETS_LIMIT = 10000
+
+    def __init__(self, rate, chat_rate, chat_burst, group_rate, max_retries):
+        self.bucket = TokenBucket(rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.queues = {priority: collections.deque() for priority in self.PRIORITIES}
+        self.stats_by_class = {
+            priority: {"sent": 0, "max_depth": 0, "wait_total": 0.0, "max_wait": 0.0}
+            for priority in self.PRIORITIES
+        }
+        self.paused_until = 0
+        self.retries = 0
+        self.wakeup = None
+        self.task = None
+
+    async def initialize(self):
+        # ExtBot вызывает initialize при каждой инициализации бота (Application и Updater)
+        if self.task is not None:
+            return
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.dispatch())
+
+    async def shutdown(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for queue in self.queues.values():
+            while queue:
+                future, _ = queue.popleft()
+                future.cancel()
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.CHAT_BUCKETS_LIMIT:
+                # Полные вёдра ничего не помнят — их можно выбросить
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.idle()}
+            if str(chat_id).startswith("-"):
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, priority):
+        """Ждёт общий токен в очереди своего класса"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues[priority]
+        queue.append((future, time.monotonic()))
+        stats = self.stats_by_class[priority]
+        stats["max_depth"] = max(stats["max_depth"], len(queue))
+        self.wakeup.set()
+        await future
+
+    async def dispatch(self):
+        """Выдаёт общие токены: сначала interactive, потом default, потом bulk"""
+        while True:
+            if not any(self.queues.values()):
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            delay = max(self.paused_until - time.monotonic(), self.bucket.delay())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            for priority in self.PRIORITIES:
+                queue = self.queues[priority]
+                while queue:
+                    future, queued_at = queue.popleft()
+                    if future.done():
+                        continue
+                    waited = time.monotonic() - queued_at
+                    stats = self.stats_by_class[priority]
+                    stats["sent"] += 1
+                    stats["wait_total"] += waited
+                    stats["max_wait"] = max(stats["max_wait"], waited)
+                    self.bucket.take()
+                    future.set_result(None)
+                    break
+                else:
+                    continue
+                break
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        priority = (rate_limit_args or {}).get("priority")
+        if priority not in self.queues:
+            priority = "interactive" if endpoint in self.INTERACTIVE_ENDPOINTS else "default"
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self.chat_bucket(chat_id).wait()
+            await self.acquire(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                print(f"⏳ Telegram просит подождать {delay} сек ({endpoint})")
+                self.retries += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def stats(self):
+        classes = {}
+        for priority in self.PRIORITIES:
+            stats = self.stats_by_class[priority]
+            classes[priority] = {
+                "depth": len(self.queues[priority]),
+                "max_depth": stats["max_depth"],
+                "sent": stats["sent"],
+                "avg_wait": round(stats["wait_total"] / stats["sent"], 3) if stats["sent"] else 0.0,
+                "max_wait": round(stats["max_wait"], 3),
+            }
+        return {
+            "classes": classes,
+            "retries": self.retries,
+            "paused_for": round(max(0.0, self.paused_until - time.monotonic()), 3),
+            "chat_buckets": len(self.chat_buckets),
+        }
+
+# Лимит Telegram общий для бота, поэтому обработчики делят SEND_RATE поровну
+send_scheduler = SendScheduler(SEND_RATE / WORKERS if RUN_MODE == "worker" else SEND_RATE, CHAT_SEND_RATE, CHAT_SEND_BURST, GROUP_SEND_RATE, SEND_MAX_RETRIES)
+
+def unreachable_reason(error):
+    """Отказ Telegram, после которого писать пользователю бессмысленно; для временных ошибок — None"""
+    description = str(error).lower()
+    if isinstance(error, Forbidden):
+        return "deactivated" if "deactivated" in description else "blocked"
+    if isinstance(error, BadRequest) and "chat not found" in description:
+        return "chat_not_found"
+    return None
+
+def mark_unreachable(uid, reason):
+    """Запоминает недоступность пользователя на UNREACHABLE_TTL секунд; вызывается под users_lock([uid])"""
+    user = get_user(uid)
+    user.unreachable = {"reason": reason, "until": time.time() + UNREACHABLE_TTL}
+    safe_save("unreachable", users=[uid])
+    print(f"{EMOJI['blocked']} Пользователь {uid} недоступен ({reason})")
+
+def is_unreachable(uid):
+    user = storage["users"].get(uid)
+    return user is not None and user.unreachable_reason(time.time()) is not None
+
+class ProfileCache:
+    """Профили пользователей (результат bot.get_chat) с TTL и LRU-вытеснением.
+
+    Одновременные запросы одного профиля ждут один общий вызов API
+    (single-flight); ошибки не кэшируются.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+
+    def peek(self, uid):
+        entry = self.entries.get(uid)
+        if entry is None:
+            return None
+        expires, profile = entry
+        if expires < time.monotonic():
+            del self.entries[uid]
+            return None
+        self.entries.move_to_end(uid)
+        return profile
+
+    def put(self, uid, profile):
+        self.entries[uid] = (time.monotonic() + self.ttl, profile)
+        self.entries.move_to_end(uid)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    async def get(self, bot, uid):
+        profile = self.peek(uid)
+        if profile is not None:
+            self.hits += 1
+            return profile
+        self.misses += 1
+        task = self.inflight.get(uid)
+        if task is None:
+            task = self.inflight[uid] = asyncio.ensure_future(self.fetch(bot, uid))
+            task.add_done_callback(lambda _: self.inflight.pop(uid, None))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    async def fetch(self, bot, uid):
+        self.requests += 1
+        profile = await bot.get_chat(uid)
+        self.put(uid, profile)
+        return profile
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "capacity": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "api_requests": self.requests,
+            "inflight": len(self.inflight),
+        }
+
+profile_cache = ProfileCache(PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE)
+
+async def get_profile(bot, uid):
+    """Профиль для упоминаний: снимок из записи пользователя, для незнакомых — get_chat через кэш.
+
+    Для недоступного пользователя без снимка — None, без запроса к Telegram.
+    """
+    user = storage["users"].get(uid)
+    if user is not None and user.profile is not None:
+        return user.profile
+    if user is not None and user.unreachable_reason(time.time()):
+        return None
+    try:
+        return await profile_cache.get(bot, uid)
+    except (Forbidden, BadRequest) as e:
+        reason = unreachable_reason(e)
+        if reason:
+            async with users_lock([uid]):
+                mark_unreachable(uid, reason)
+        raise
+
+async def fetch_profiles(bot, uids):
+    """Профили пользователей одним параллельным проходом; недоступные — None"""
+    semaphore = asyncio.Semaphore(DRAW_CONCURRENCY)
+
+    async def fetch(uid):
+        async with semaphore:
+            try:
+                return uid, await get_profile(bot, uid)
+            except Exception as e:
+                print(f"Ошибка получения пользователя {uid}: {e}")
+                return uid, None
+
+    return dict(await asyncio.gather(*(fetch(uid) for uid in uids)))
+
+# ========== ОЧЕРЕДЬ СООБЩЕНИЙ ==========
+
+# Обработчики не отправляют уведомления сами, а кладут их в storage["outbox"]:
+# очередь сохраняется вместе с остальными данными, её разбирает outbox_loop.
+# Сообщение, отправленное перед падением, но не отмеченное на диске как sent,
+# после перезапуска уйдёт ещё раз (доставка «хотя бы один раз»).
+# Новое сообщение отправляется только после записи пачки, в которой оно стоит:
+# иначе после сбоя записи получатель знал бы то, чего нет на диске (например,
+# результат распределения, которое можно провести заново).
+
+outbox_pending = {message_id for message_id, message in storage["outbox"].items() if message["status"] == "pending"}
+outbox_unsaved = set()
+outbox_seq = itertools.count(max((message["seq"] for message in storage["outbox"].values()), default=0) + 1)
+outbox_wakeup = asyncio.Event()
+
+def enqueue_message(chat_id, text, group=None):
+    """Ставит сообщение в очередь; возвращает его id.
+
+    group — метка для подсчёта прогресса (например, рассылка одной игры).
+    Запись на диск — вместе со следующим safe_save/flush; отправка — после неё.
+    """
+    message_id = uuid.uuid4().hex
+    storage["outbox"][message_id] = {
+        "id": message_id,
+        "seq": next(outbox_seq),
+        "chat_id": chat_id,
+        "text": text,
+        "group": group,
+        # Отправляет тот обработчик, который поставил сообщение в очередь
+        "worker": WORKER_SLOT,
+        "status": "pending",
+        "attempts": 0,
+        "next_at": time.time(),
+        "created": time.time(),
+        "done_at": None,
+        "error": None,
+    }
+    outbox_unsaved.add(message_id)
+    mark_dirty(outbox=[message_id])
+    return message_id
+
+def release_saved_messages(message_ids):
+    """Сообщения из записанной пачки становятся доступны outbox_loop"""
+    saved = outbox_unsaved.intersection(message_ids)
+    if saved:
+        outbox_unsaved.difference_update(saved)
+        outbox_pending.update(saved)
+        outbox_wakeup.set()
+
+def finish_message(message, status, error=None):
+    message["status"] = status
+    message["done_at"] = time.time()
+    message["error"] = error
+    outbox_pending.discard(message["id"])
+
+async def deliver(bot, message):
+    """Одна попытка отправки; возвращает True, если сообщение больше не ждёт отправки"""
+    user = storage["users"].get(message["chat_id"])
+    reason = user and user.unreachable_reason(time.time())
+    if reason:
+        finish_message(message, "skipped", reason)
+        mark_dirty(outbox=[message["id"]])
+        return True
+    try:
+        await bot.send_message(
+            message["chat_id"],
+            message["text"],
+            parse_mode="HTML",
+            disable_web_page_preview=True,
+            rate_limit_args={"priority": "bulk"},
+        )
+    except RetryAfter as e:
+        # Планировщик уже исчерпал повторы; попытка не засчитывается
+        message["next_at"] = time.time() + retry_after_seconds(e)
+        return False
+    except (Forbidden, BadRequest) as e:
+        # Бот заблокирован, чат не найден, неверная разметка — повтор не поможет
+        print(f"Сообщение {message['chat_id']} не доставлено: {e}")
+        finish_message(message, "failed", str(e))
+        reason = unreachable_reason(e)
+        if reason:
+            async with users_lock([message["chat_id"]]):
+                mark_unreachable(message["chat_id"], reason)
+        return True
+    except Exception as e:
+        message["attempts"] += 1
+        if message["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            print(f"❌ Сообщение {message['chat_id']} не доставлено после {message['attempts']} попыток: {e}")
+            finish_message(message, "failed", str(e))
+            return True
+        message["error"] = str(e)
+        message["next_at"] = time.time() + min(OUTBOX_MAX_BACKOFF, OUTBOX_RETRY_BASE * 2 ** (message["attempts"] - 1))
+        return False
+    else:
+        finish_message(message, "sent")
+        return True
+    finally:
+        mark_dirty(outbox=[message["id"]])
+
+async def drain_outbox(bot, semaphore):
+    """Отправляет все сообщения, срок которых наступил.
+
+    Сообщения одного чата уходят по порядку постановки, разные чаты — параллельно.
+    Если сообщение отложено, следующие в тот же чат ждут его.
+    """
+    now = time.time()
+    chats = collections.defaultdict(list)
+    for message_id in outbox_pending:
+        message = storage["outbox"][message_id]
+        chats[message["chat_id"]].append(message)
+
+    async def send_chat(messages):
+        messages.sort(key=lambda message: message["seq"])
+        for message in messages:
+            if message["next_at"] > now:
+                return
+            async with semaphore:
+                if not await deliver(bot, message):
+                    return
+
+    await asyncio.gather(*(send_chat(messages) for messages in chats.values()))
+
+def outbox_next_at():
+    """Срок, к которому outbox_loop нужно проснуться; None — ждать нечего.
+
+    Учитывается только первое по порядку ожидающее сообщение каждого чата:
+    следующие ждут его, даже если их собственный срок уже наступил.
+    """
+    heads = {}
+    for message_id in outbox_pending:
+        message = storage["outbox"][message_id]
+        head = heads.get(message["chat_id"])
+        if head is None or message["seq"] < head["seq"]:
+            heads[message["chat_id"]] = message
+    return min((message["next_at"] for message in heads.values()), default=None)
+
+async def outbox_loop(bot):
+    """Фоновая отправка очереди: просыпается при постановке сообщения или к сроку повтора"""
+    semaphore = asyncio.Semaphore(DRAW_CONCURRENCY)
+    while True:
+        outbox_wakeup.clear()
+        try:
+            await drain_outbox(bot, semaphore)
+        except Exception as e:
+            print(f"❌ Ошибка отправки очереди сообщений: {e}")
+        timeout = None
+        next_at = outbox_next_at()
+        if next_at is not None:
+            timeout = max(0.0, next_at - time.time())
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def outbox_status(group=None):
+    """Число сообщений по статусам (pending/sent/failed/skipped), для group — только её.
+
+    skipped — получатель уже был известен как недоступный, запроса к Telegram не было.
+    """
+    counts = collections.Counter({"pending": 0, "sent": 0, "failed": 0, "skipped": 0})
+    for message in storage["outbox"].values():
+        if group is None or message["group"] == group:
+            counts[message["status"]] += 1
+    return counts
+
+def purge_outbox():
+    """Удаляет из очереди давно отправленные и недоставленные сообщения"""
+    deadline = time.time() - OUTBOX_RETENTION
+    expired = [
+        message_id for message_id, message in storage["outbox"].items()
+        if message["status"] != "pending" and message["done_at"] < deadline
+    ]
+    for message_id in expired:
+        del storage["outbox"][message_id]
+    if expired:
+        safe_save("outbox_purge", outbox=expired)
+    return len(expired)
 
 # ========== ФУНКЦИИ ДЛЯ ПРЕДОТВРАЩЕНИЯ СНА ==========
 
@@ -271,7 +1693,6 @@ def start_ping_loop():
         while True:
             try:
                 ping_self()
-                safe_save()
                 time.sleep(PING_INTERVAL)  # Спим 5 минут
             except Exception as e:
                 print(f"❌ Ошибка в пинг-воркере: {e}")
@@ -282,12 +1703,96 @@ def start_ping_loop():
     ping_thread.start()
     print(f"📡 Фоновый пинг запущен (интервал: {PING_INTERVAL} сек)")
 
+# ========== КНОПКИ ==========
+
+# callback_data кнопки — "<версия>:<код действия>[:аргумент...]", например "1:k:ab12cd34:42".
+# Короткий код вместо имени экономит 64 байта, отведённые Telegram; при смене формата
+# CALLBACK_VERSION увеличивается, и кнопки в старых сообщениях распознаются по версии
+CALLBACK_VERSION = "1"
+CALLBACK_CODES = {
+    "main_menu": "m",
+    "create_game": "c",
+    "join_game": "j",
+    "my_games": "l",
+    "game": "g",
+    "invite": "i",
+    "players": "p",
+    "kick": "k",
+    "delete": "d",
+    "edit_amount": "a",
+    "start_game": "s",
+    "wish": "w",
+    "edit_wish": "ew",
+    "delete_wish": "dw",
+    "skip_not_wish": "sn",
+}
+CALLBACK_ACTIONS = {code: action for action, code in CALLBACK_CODES.items()}
+
+def pack_callback(action, *args):
+    return ":".join((CALLBACK_VERSION, CALLBACK_CODES[action], *map(str, args)))
+
+def parse_callback(data):
+    """(действие, аргументы) из callback_data; (None, []) — кнопка не распознана.
+
+    Кнопки, отправленные до версионирования, имели вид "<действие>_<игра>[_<id>]":
+    действие находится не больше чем двумя поисками в CALLBACK_CODES.
+    """
+    version, sep, payload = data.partition(":")
+    if sep:
+        if version != CALLBACK_VERSION:
+            return None, []
+        code, *args = payload.split(":")
+        return CALLBACK_ACTIONS.get(code), args
+    if data in CALLBACK_CODES:
+        return data, []
+    action, _, arg = data.rpartition("_")
+    if action in CALLBACK_CODES:
+        return action, [arg]
+    action, _, game_id = action.rpartition("_")
+    if action in CALLBACK_CODES:
+        return action, [game_id, arg]
+    return None, []
+
+# ========== ПРОФИЛИ ==========
+
+def profile_is_current(user, tg_user):
+    """Снимок профиля совпадает с обновлением и отметка «был в сети» ещё не устарела"""
+    profile = user.profile
+    return (
+        profile is not None
+        and profile.matches(tg_user)
+        and int(time.time()) - profile.seen < PROFILE_SEEN_RESOLUTION
+    )
+
+async def capture_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запоминает имя и username отправителя любого обновления (группа -1, до основных обработчиков)"""
+    tg_user = update.effective_user
+    if tg_user is None or tg_user.is_bot:
+        return
+    member = update.my_chat_member
+    blocked = member is not None and member.new_chat_member.status == ChatMember.BANNED
+    user = storage["users"].get(tg_user.id)
+    # Обычно менять нечего — тогда обходимся без блокировки записи
+    if not blocked and user is not None and user.unreachable is None and profile_is_current(user, tg_user):
+        return
+    async with users_lock([tg_user.id]):
+        user = get_user(tg_user.id)
+        if blocked:
+            # Пользователь заблокировал бота — Telegram сообщает об этом сам
+            mark_unreachable(tg_user.id, "blocked")
+        elif user.unreachable is not None:
+            # Пользователь снова пишет боту — значит, сообщения до него дойдут
+            user.unreachable = None
+            safe_save("reachable", users=[tg_user.id])
+        if profile_is_current(user, tg_user):
+            return
+        user.profile = Profile.from_telegram(tg_user, int(time.time()))
+        safe_save("profile", users=[tg_user.id])
+
 # ========== КОМАНДЫ ==========
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = get_user(update.effective_user.id)
-    user["state"] = None
-    safe_save()
+    conversations.clear(update.effective_user.id)
 
     welcome_text = (
         f"{EMOJI['gift']} <b>Тайный Санта</b>\n\n"
@@ -296,9 +1801,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     keyboard = [
-        [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data="create_game")],
-        [InlineKeyboardButton(f"{EMOJI['join']} Присоединиться", callback_data="join_game")],
-        [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
+        [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data=pack_callback("create_game"))],
+        [InlineKeyboardButton(f"{EMOJI['join']} Присоединиться", callback_data=pack_callback("join_game"))],
+        [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
         [InlineKeyboardButton(f"{EMOJI['help']} FAQ и инструкции", url=FAQ_CHANNEL_LINK)],
     ]
 
@@ -309,9 +1814,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = get_user(update.effective_user.id)
-    user["state"] = None
-    safe_save()
+    conversations.clear(update.effective_user.id)
 
     welcome_text = (
         f"{EMOJI['gift']} <b>Главное меню</b>\n\n"
@@ -320,9 +1823,9 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     keyboard = [
-        [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data="create_game")],
-        [InlineKeyboardButton(f"{EMOJI['join']} Присоединиться", callback_data="join_game")],
-        [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
+        [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data=pack_callback("create_game"))],
+        [InlineKeyboardButton(f"{EMOJI['join']} Присоединиться", callback_data=pack_callback("join_game"))],
+        [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
         [InlineKeyboardButton(f"{EMOJI['help']} FAQ и инструкции", url=FAQ_CHANNEL_LINK)],
     ]
 
@@ -333,13 +1836,7 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = get_user(update.effective_user.id)
-    user["state"] = None
-    if "tmp_name" in user:
-        del user["tmp_name"]
-    if "tmp_game_id" in user:
-        del user["tmp_game_id"]
-    safe_save()
+    conversations.clear(update.effective_user.id)
 
     await update.message.reply_text(
         f"{EMOJI['check']} Действие отменено. Используй /menu для возврата в меню."
@@ -363,7 +1860,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     keyboard = [
         [InlineKeyboardButton(f"{EMOJI['link']} Перейти в FAQ канал", url=FAQ_CHANNEL_LINK)],
-        [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
     ]
     
     await update.message.reply_text(
@@ -380,9 +1877,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"{EMOJI['cross']} У вас нет доступа к этой команде.")
         return
     
-    active_games = len([g for g in storage["games"].values() if not g.get("started")])
-    finished_games = len([g for g in storage["games"].values() if g.get("started")])
-    users_with_games = len([u for u in storage["users"].values() if u.get("games")])
+    counts = storage_counts()
     
     last_save = storage.get("_metadata", {}).get("last_save", "неизвестно")
     if isinstance(last_save, (int, float)):
@@ -391,17 +1886,25 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stats_text = (
         f"{EMOJI['info']} <b>Статистика бота</b>\n\n"
         f"📊 <b>Общая статистика:</b>\n"
-        f"• Всего пользователей: {len(storage['users'])}\n"
-        f"• Пользователей с играми: {users_with_games}\n"
-        f"• Всего игр: {len(storage['games'])}\n"
-        f"• Активных игр: {active_games}\n"
-        f"• Завершенных игр: {finished_games}\n\n"
+        f"• Всего пользователей: {counts['users']}\n"
+        f"• Пользователей с играми: {counts['users_with_games']}\n"
+        f"• Всего игр: {counts['games']}\n"
+        f"• Активных игр: {counts['active_games']}\n"
+        f"• Завершенных игр: {counts['finished_games']}\n\n"
         f"💾 <b>Система:</b>\n"
         f"• Последнее сохранение: {last_save}\n"
-        f"• Размер файла данных: {os.path.getsize(STORAGE_FILE) if os.path.exists(STORAGE_FILE) else 0} байт\n"
-        f"• Есть бэкап: {'✅' if os.path.exists(BACKUP_FILE) else '❌'}\n"
+        f"• Размер файла данных: {storage_size()} байт\n"
+        f"• Есть бэкап: {'✅' if os.path.exists(backend.backup_path) else '❌'}\n"
         f"• Пинг-система: {'✅ активна' if 'ping_active' in storage.get('_metadata', {}) else '❌ неактивна'}"
     )
+    cache = cache_stats()
+    if cache:
+        stats_text += (
+            f"\n• Кэш игр: {cache['games']['resident']}/{cache['games']['capacity']}, "
+            f"попаданий {cache['games']['hits']}, промахов {cache['games']['misses']}\n"
+            f"• Кэш пользователей: {cache['users']['resident']}/{cache['users']['capacity']}, "
+            f"попаданий {cache['users']['hits']}, промахов {cache['users']['misses']}"
+        )
     
     await update.message.reply_text(
         stats_text,
@@ -412,71 +1915,67 @@ async def handle_start_with_param(update: Update, context: ContextTypes.DEFAULT_
     args = context.args
     if args and len(args[0]) == 8:
         game_id = args[0]
-        game = storage["games"].get(game_id)
-
-        if not game:
-            await update.message.reply_text(
-                f"{EMOJI['cross']} <b>Игра не найдена!</b>\n\n"
-                f"Ссылка устарела или игра была удалена.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            return
+        user_id = update.effective_user.id
 
-        if game.get("started"):
-            await update.message.reply_text(
-                f"{EMOJI['cross']} <b>Игра уже началась!</b>\n\n"
-                f"Распределение уже проведено, присоединиться нельзя.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            return
+        async with game_lock(game_id):
+            game = storage["games"].get(game_id)
 
-        user_id = str(update.effective_user.id)
+            if not game:
+                await update.message.reply_text(
+                    f"{EMOJI['cross']} <b>Игра не найдена!</b>\n\n"
+                    f"Ссылка устарела или игра была удалена.",
+                    parse_mode="HTML",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
+                    ])
+                )
+                return
 
-        if user_id in game.get("players", []):
-            await update.message.reply_text(
-                f"{EMOJI['info']} <b>Ты уже в игре!</b>\n\n"
-                f"{EMOJI['tree']} <b>{escape_markdown(game['name'])}</b>\n"
-                f"{EMOJI['money']} <b>Сумма:</b> {game['amount']} ₽\n"
-                f"{EMOJI['users']} <b>Участников:</b> {len(game['players'])}\n\n"
-                f"Ждем начала распределения!",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            return
+            if game.started:
+                await update.message.reply_text(
+                    f"{EMOJI['cross']} <b>Игра уже началась!</b>\n\n"
+                    f"Распределение уже проведено, присоединиться нельзя.",
+                    parse_mode="HTML",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
+                    ])
+                )
+                return
 
-        game.setdefault("players", []).append(user_id)
-        user = get_user(user_id)
-        user.setdefault("games", []).append(game_id)
-        safe_save()
+            if user_id in game.players:
+                await update.message.reply_text(
+                    f"{EMOJI['info']} <b>Ты уже в игре!</b>\n\n"
+                    f"{EMOJI['tree']} <b>{escape_markdown(game.name)}</b>\n"
+                    f"{EMOJI['money']} <b>Сумма:</b> {game.amount} ₽\n"
+                    f"{EMOJI['users']} <b>Участников:</b> {len(game.players)}\n\n"
+                    f"Ждем начала распределения!",
+                    parse_mode="HTML",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
+                    ])
+                )
+                return
 
-        try:
-            await context.bot.send_message(
-                game["owner"],
-                f"{EMOJI['bell']} <b>Новый участник!</b>\n\n"
-                f"К игре '{escape_markdown(game['name'])}' присоединился новый участник.\n"
-                f"{EMOJI['users']} Теперь участников: {len(game['players'])}",
-                parse_mode="HTML"
-            )
-        except:
-            pass
+            async with users_lock([user_id]):
+                game.players.add(user_id)
+                get_user(user_id).games.add(game_id)
+                enqueue_message(
+                    game.owner,
+                    f"{EMOJI['bell']} <b>Новый участник!</b>\n\n"
+                    f"К игре '{escape_markdown(game.name)}' присоединился новый участник.\n"
+                    f"{EMOJI['users']} Теперь участников: {len(game.players)}",
+                )
+                safe_save("join", games=[game_id], users=[user_id])
 
         await update.message.reply_text(
             f"{EMOJI['check']} <b>Ты присоединился к игре!</b>\n\n"
-            f"{EMOJI['tree']} <b>{escape_markdown(game['name'])}</b>\n"
-            f"{EMOJI['money']} <b>Сумма:</b> {game['amount']} ₽\n"
-            f"{EMOJI['users']} <b>Участников:</b> {len(game['players'])}\n\n"
+            f"{EMOJI['tree']} <b>{escape_markdown(game.name)}</b>\n"
+            f"{EMOJI['money']} <b>Сумма:</b> {game.amount} ₽\n"
+            f"{EMOJI['users']} <b>Участников:</b> {len(game.players)}\n\n"
             f"{EMOJI['santa']} Ждем, когда создатель запустит распределение!",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
             ])
         )
             
@@ -488,9 +1987,7 @@ async def create_game_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    user = get_user(query.from_user.id)
-    user["state"] = "wait_game_name"
-    safe_save()
+    conversations.get(query.from_user.id)["state"] = "wait_game_name"
 
     await query.edit_message_text(
         f"{EMOJI['create']} <b>Создание игры</b>\n\n"
@@ -500,7 +1997,7 @@ async def create_game_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{EMOJI['info']} <i>Используй /cancel для отмены</i>",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
+            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
         ])
     )
 
@@ -508,9 +2005,7 @@ async def join_game_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    user = get_user(query.from_user.id)
-    user["state"] = "wait_join_code"
-    safe_save()
+    conversations.get(query.from_user.id)["state"] = "wait_join_code"
     
     await query.edit_message_text(
         f"{EMOJI['info']} <b>Для присоединения к игре нужна ссылка от организатора</b>\n\n"
@@ -518,26 +2013,51 @@ async def join_game_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Если ты организатор — создай новую игру или зайди в свои существующие игры.",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data="create_game")],
-            [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
-            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+            [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data=pack_callback("create_game"))],
+            [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
+            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
         ])
     )
 
+async def indexed_active_games(user):
+    """Незавершённые игры пользователя по индексу участников SQLite.
+
+    Завершённые игры из user.games с диска не читаются. Запрос видит только
+    записанное, поэтому сначала сохраняются накопленные изменения.
+    """
+    if storage_dirty:
+        await flush_and_wait()
+    order = {game_id: i for i, game_id in enumerate(user.games)}
+    game_ids = sorted(backend.user_active_games(user.id), key=lambda game_id: order.get(game_id, len(order)))
+    games = (storage["games"].get(game_id) for game_id in game_ids)
+    return [game for game in games if game and user.id in game.players and not game.started]
+
 async def my_games_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    user_id = str(query.from_user.id)
-    removed = cleanup_finished_games()
+    user_id = query.from_user.id
     
     user_games = []
     user = get_user(user_id)
+    stale_games = []
     
-    for game_id in user.get("games", []):
-        game = storage["games"].get(game_id)
-        if game and not game.get("started"):
-            user_games.append(game)
+    if is_lazy_storage():
+        user_games = await indexed_active_games(user)
+    else:
+        for game_id in user.games:
+            game = storage["games"].get(game_id)
+            if not game or user_id not in game.players:
+                stale_games.append(game_id)
+            elif not game.started:
+                user_games.append(game)
+
+    if stale_games:
+        async with users_lock([user_id]):
+            user = get_user(user_id)
+            for game_id in stale_games:
+                user.games.discard(game_id)
+            safe_save("cleanup", users=[user_id])
 
     if not user_games:
         await query.edit_message_text(
@@ -545,7 +2065,7 @@ async def my_games_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Создай новую игру или присоединись к существующей!",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
             ])
         )
         return
@@ -554,18 +2074,18 @@ async def my_games_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     buttons = []
 
     for game in user_games[:10]:
-        is_owner = f"{EMOJI['crown']} " if game.get("owner") == user_id else ""
-        game_name = escape_markdown(game.get("name", "Без названия"))
+        is_owner = f"{EMOJI['crown']} " if game.owner == user_id else ""
+        game_name = escape_markdown(game.name)
         
         text += f"{is_owner}<b>{game_name}</b>\n"
-        text += f"   {EMOJI['users']} {len(game.get('players', []))} | {EMOJI['money']} {game.get('amount', 0)} ₽\n\n"
+        text += f"   {EMOJI['users']} {len(game.players)} | {EMOJI['money']} {game.amount} ₽\n\n"
         
-        buttons.append([InlineKeyboardButton(f"{game_name[:15]}...", callback_data=f"game_{game['id']}")])
+        buttons.append([InlineKeyboardButton(f"{game_name[:15]}...", callback_data=pack_callback("game", game.id))])
 
     if len(user_games) > 10:
         text += f"\n{EMOJI['info']} Показано 10 из {len(user_games)} игр"
 
-    buttons.append([InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")])
+    buttons.append([InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))])
 
     await query.edit_message_text(
         text,
@@ -577,59 +2097,52 @@ async def game_details_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    game_id = query.data.split("_")[1]
+    game_id = context.args[0]
     game = storage["games"].get(game_id)
 
-    if not game or game.get("started"):
+    if not game or game.started:
         await query.edit_message_text(
             f"{EMOJI['cross']} Игра не найдена или уже завершена",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
-                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
+                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
             ])
         )
         return
 
-    user_id = str(query.from_user.id)
-    game_name = escape_markdown(game["name"])
+    user_id = query.from_user.id
+    game_name = escape_markdown(game.name)
 
     text = (
         f"{EMOJI['tree']} <b>{game_name}</b>\n"
-        f"{EMOJI['money']} <b>Бюджет:</b> {game['amount']} ₽\n"
-        f"{EMOJI['users']} <b>Участников:</b> {len(game['players'])}"
+        f"{EMOJI['money']} <b>Бюджет:</b> {game.amount} ₽\n"
+        f"{EMOJI['users']} <b>Участников:</b> {len(game.players)}"
     )
 
-    user = get_user(user_id)
-    has_wishes = False
-    if "wishes" in user and game_id in user["wishes"]:
-        wishes = user["wishes"][game_id]
-        if wishes.get("wish") or wishes.get("not_wish"):
-            has_wishes = True
-
     keyboard = []
 
-    if user_id == game["owner"]:
+    if user_id == game.owner:
         keyboard.append([
-            InlineKeyboardButton(f"{EMOJI['link']} Пригласить", callback_data=f"invite_{game_id}"),
-            InlineKeyboardButton(f"{EMOJI['users']} Участники", callback_data=f"players_{game_id}")
+            InlineKeyboardButton(f"{EMOJI['link']} Пригласить", callback_data=pack_callback("invite", game_id)),
+            InlineKeyboardButton(f"{EMOJI['users']} Участники", callback_data=pack_callback("players", game_id))
         ])
-        keyboard.append([InlineKeyboardButton(f"{EMOJI['play']} Запустить распределение", callback_data=f"start_game_{game_id}")])
+        keyboard.append([InlineKeyboardButton(f"{EMOJI['play']} Запустить распределение", callback_data=pack_callback("start_game", game_id))])
         keyboard.append([
-            InlineKeyboardButton(f"{EMOJI['edit']} Изменить сумму", callback_data=f"edit_amount_{game_id}"),
-            InlineKeyboardButton(f"{EMOJI['trash']} Удалить игру", callback_data=f"delete_{game_id}")
+            InlineKeyboardButton(f"{EMOJI['edit']} Изменить сумму", callback_data=pack_callback("edit_amount", game_id)),
+            InlineKeyboardButton(f"{EMOJI['trash']} Удалить игру", callback_data=pack_callback("delete", game_id))
         ])
-    elif user_id in game["players"]:
+    elif user_id in game.players:
         keyboard.append([
-            InlineKeyboardButton(f"{EMOJI['users']} Участники", callback_data=f"players_{game_id}")
+            InlineKeyboardButton(f"{EMOJI['users']} Участники", callback_data=pack_callback("players", game_id))
         ])
 
-    if user_id in game["players"]:
-        wish_button_text = f"{EMOJI['preferences']} Мои пожелания" if has_wishes else f"{EMOJI['wish']} Указать пожелания"
-        keyboard.append([InlineKeyboardButton(wish_button_text, callback_data=f"wish_{game_id}")])
+    if user_id in game.players:
+        wish_button_text = f"{EMOJI['preferences']} Мои пожелания" if has_wishes(game, user_id) else f"{EMOJI['wish']} Указать пожелания"
+        keyboard.append([InlineKeyboardButton(wish_button_text, callback_data=pack_callback("wish", game_id))])
 
     keyboard.append([
-        InlineKeyboardButton(f"{EMOJI['back']} К списку игр", callback_data="my_games"),
-        InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")
+        InlineKeyboardButton(f"{EMOJI['back']} К списку игр", callback_data=pack_callback("my_games")),
+        InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))
     ])
 
     await query.edit_message_text(
@@ -642,7 +2155,7 @@ async def invite_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[1]
+    game_id = context.args[0]
     game = storage["games"].get(game_id)
     
     if not game:
@@ -650,21 +2163,21 @@ async def invite_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     invite_link = f"https://t.me/{context.bot.username}?start={game_id}"
-    game_name = escape_markdown(game["name"])
+    game_name = escape_markdown(game.name)
     
     text = (
         f"{EMOJI['gift']} <b>Приглашение в игру</b>\n\n"
         f"{EMOJI['tree']} <b>{game_name}</b>\n"
-        f"{EMOJI['money']} <b>Сумма подарка:</b> {game['amount']} ₽\n"
-        f"{EMOJI['users']} <b>Участников:</b> {len(game['players'])}\n\n"
+        f"{EMOJI['money']} <b>Сумма подарка:</b> {game.amount} ₽\n"
+        f"{EMOJI['users']} <b>Участников:</b> {len(game.players)}\n\n"
         f"{EMOJI['link']} <b>Ссылка для приглашения:</b>\n"
         f"{invite_link}\n\n"
         f"{EMOJI['snowflake']} Просто отправь эту ссылку друзьям!"
     )
     
     keyboard = [
-        [InlineKeyboardButton(f"{EMOJI['back']} Назад к игре", callback_data=f"game_{game_id}")],
-        [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(f"{EMOJI['back']} Назад к игре", callback_data=pack_callback("game", game_id))],
+        [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
     ]
     
     await query.edit_message_text(
@@ -677,51 +2190,59 @@ async def players_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[1]
+    game_id = context.args[0]
     game = storage["games"].get(game_id)
     
     if not game:
         await query.edit_message_text(
             f"{EMOJI['cross']} Игра не найдена",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
-                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
+                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
             ])
         )
         return
     
-    players_text = f"{EMOJI['users']} <b>Участники ({len(game['players'])}):</b>\n\n"
+    players_text = f"{EMOJI['users']} <b>Участники ({len(game.players)}):</b>\n\n"
     buttons = []
     
-    for i, uid in enumerate(game["players"], 1):
+    # Список копируется: во время await участник может выйти или быть удалён
+    players = list(game.players)
+    profiles = await fetch_profiles(context.bot, players)
+    unreachable_count = 0
+    
+    for i, uid in enumerate(players, 1):
         try:
-            user_info = await context.bot.get_chat(int(uid))
-            mention = get_user_html_mention(uid, user_info)
+            user_info = profiles[uid]
+            unreachable = is_unreachable(uid)
+            if user_info is None and not unreachable:
+                raise LookupError("профиль недоступен")
+            mention = get_user_html_mention(uid, user_info) if user_info else f"Игрок {i}"
+            player_has_wishes = has_wishes(game, uid)
             
-            user = get_user(uid)
-            has_wishes = False
-            if "wishes" in user and game_id in user["wishes"]:
-                wishes = user["wishes"][game_id]
-                if wishes.get("wish") or wishes.get("not_wish"):
-                    has_wishes = True
-            
-            if uid == game["owner"]:
+            if uid == game.owner:
                 players_text += f"{i}. {EMOJI['crown']} {mention}"
-                if has_wishes:
+                if player_has_wishes:
                     players_text += f" {EMOJI['wish']}"
             else:
                 players_text += f"{i}. {EMOJI['user']} {mention}"
-                if has_wishes:
+                if player_has_wishes:
                     players_text += f" {EMOJI['wish']}"
             
+            if unreachable:
+                players_text += f" {EMOJI['blocked']}"
+                unreachable_count += 1
+            
             players_text += "\n"
             
-            if query.from_user.id == int(game["owner"]) and uid != game["owner"]:
-                name = escape_markdown(user_info.first_name or user_info.username or f"Игрок {i}")
+            if query.from_user.id == game.owner and uid != game.owner:
+                name = f"Игрок {i}"
+                if user_info:
+                    name = escape_markdown(user_info.first_name or user_info.username or name)
                 buttons.append([
                     InlineKeyboardButton(
                         f"{EMOJI['cross']} Удалить {name[:15]}",
-                        callback_data=f"kick_{game_id}_{uid}"
+                        callback_data=pack_callback("kick", game_id, uid)
                     )
                 ])
                 
@@ -729,15 +2250,20 @@ async def players_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             print(f"Ошибка получения пользователя {uid}: {e}")
             players_text += f"{i}. Игрок {i}\n"
     
-    game_name = escape_markdown(game["name"])
+    game_name = escape_markdown(game.name)
     text = f"{EMOJI['tree']} <b>{game_name}</b>\n\n{players_text}"
     
-    if query.from_user.id == int(game["owner"]):
+    if query.from_user.id == game.owner:
         text += f"\n{EMOJI['wish']} - участник указал пожелания"
+        if unreachable_count:
+            text += (
+                f"\n{EMOJI['blocked']} - бот не может написать участнику (заблокировал бота или удалил аккаунт): "
+                f"он не узнает своего получателя"
+            )
     
     buttons.append([
-        InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data=f"game_{game_id}"),
-        InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")
+        InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data=pack_callback("game", game_id)),
+        InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))
     ])
     
     await query.edit_message_text(
@@ -751,32 +2277,36 @@ async def kick_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    _, game_id, uid = query.data.split("_")
-    game = storage["games"][game_id]
+    game_id, uid = context.args
+    uid = int(uid)
     
-    if uid in game["players"]:
-        try:
-            user_info = await context.bot.get_chat(int(uid))
-            user_name = escape_markdown(user_info.first_name or user_info.username or "Игрок")
-            game["players"].remove(uid)
-            safe_save()
-            
-            try:
-                await context.bot.send_message(
-                    uid,
-                    f"{EMOJI['cross']} <b>Тебя удалили из игры</b>\n\n"
-                    f"{EMOJI['tree']} Игра: {escape_markdown(game['name'])}\n"
-                    f"{EMOJI['info']} Создатель игры принял решение об твоем удалении.",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
-            
-            await query.answer(f"✅ {user_name} удален", show_alert=True)
-        except:
-            game["players"].remove(uid)
-            safe_save()
-            await query.answer("✅ Игрок удален", show_alert=True)
+    async with game_lock(game_id):
+        game = storage["games"].get(game_id)
+        if not game:
+            await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
+            return
+        if game.started:
+            await query.answer(f"{EMOJI['info']} Распределение уже проведено!", show_alert=True)
+            return
+        if uid not in game.players:
+            await players_cb(update, context)
+            return
+        async with users_lock([uid]):
+            remove_player(game, uid)
+            enqueue_message(
+                uid,
+                f"{EMOJI['cross']} <b>Тебя удалили из игры</b>\n\n"
+                f"{EMOJI['tree']} Игра: {escape_markdown(game.name)}\n"
+                f"{EMOJI['info']} Создатель игры принял решение об твоем удалении.",
+            )
+            safe_save("kick", games=[game_id], users=[uid])
+    
+    try:
+        user_info = await get_profile(context.bot, uid)
+        user_name = escape_markdown(user_info.first_name or user_info.username or "Игрок")
+        await query.answer(f"✅ {user_name} удален", show_alert=True)
+    except:
+        await query.answer("✅ Игрок удален", show_alert=True)
     
     await players_cb(update, context)
 
@@ -784,26 +2314,24 @@ async def edit_amount_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[2]
+    game_id = context.args[0]
     game = storage["games"][game_id]
     
-    if query.from_user.id != int(game["owner"]):
+    if query.from_user.id != game.owner:
         await query.answer(f"{EMOJI['cross']} Только создатель игры может менять сумму!", show_alert=True)
         return
     
-    user = get_user(query.from_user.id)
-    user["state"] = f"wait_new_amount_{game_id}"
-    safe_save()
+    conversations.get(query.from_user.id).update(state="wait_new_amount", tmp_game_id=game_id)
     
     await query.edit_message_text(
         f"{EMOJI['edit']} <b>Изменение суммы</b>\n\n"
-        f"{EMOJI['tree']} Игра: {escape_markdown(game['name'])}\n"
-        f"{EMOJI['money']} Текущая сумма: {game['amount']} ₽\n\n"
+        f"{EMOJI['tree']} Игра: {escape_markdown(game.name)}\n"
+        f"{EMOJI['money']} Текущая сумма: {game.amount} ₽\n\n"
         f"Введи новую сумму:\n\n"
         f"{EMOJI['info']} <i>Используй /cancel для отмены</i>",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
+            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
         ])
     )
 
@@ -811,58 +2339,56 @@ async def start_game_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[2]
-    game = storage["games"].get(game_id)
-    
-    if not game:
-        await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
-        return
-    
-    if query.from_user.id != int(game["owner"]):
-        await query.answer(f"{EMOJI['cross']} Только создатель игры может запустить распределение!", show_alert=True)
-        return
-    
-    if len(game["players"]) < 2:
-        await query.answer(f"{EMOJI['cross']} Нужно минимум 2 участника!", show_alert=True)
-        return
-    
-    if game.get("started"):
-        await query.answer(f"{EMOJI['info']} Распределение уже проведено!", show_alert=True)
-        return
-    
-    players = game["players"][:]
-    random.shuffle(players)
+    game_id = context.args[0]
+    group = f"draw_{game_id}"
     
-    pairs = {}
-    for i in range(len(players)):
-        giver = players[i]
-        receiver = players[(i + 1) % len(players)]
-        pairs[giver] = receiver
-    
-    game["pairs"] = pairs
-    game["started"] = True
-    safe_save()
-    
-    success_count = 0
-    for giver, receiver in pairs.items():
-        try:
-            receiver_info = await context.bot.get_chat(receiver)
-            receiver_mention = get_user_html_mention(receiver, receiver_info)
+    # Состав игры фиксируется под блокировкой: параллельный join/kick ждёт записи распределения.
+    # Сообщения ставятся в очередь в той же пачке, что и started=True, поэтому после
+    # перезапуска рассылка продолжится, а не потеряется
+    async with game_lock(game_id):
+        game = storage["games"].get(game_id)
+        
+        if not game:
+            await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
+            return
+        
+        if query.from_user.id != game.owner:
+            await query.answer(f"{EMOJI['cross']} Только создатель игры может запустить распределение!", show_alert=True)
+            return
+        
+        if len(game.players) < 2:
+            await query.answer(f"{EMOJI['cross']} Нужно минимум 2 участника!", show_alert=True)
+            return
+        
+        if game.started:
+            await query.answer(f"{EMOJI['info']} Распределение уже проведено!", show_alert=True)
+            return
+        
+        players = list(game.players)
+        profiles = await fetch_profiles(context.bot, players)
+        random.shuffle(players)
+        
+        pairs = {}
+        for i in range(len(players)):
+            giver = players[i]
+            receiver = players[(i + 1) % len(players)]
+            pairs[giver] = receiver
+        
+        for giver, receiver in pairs.items():
+            receiver_mention = get_user_html_mention(receiver, profiles.get(receiver))
             
             receiver_wishes = ""
-            receiver_user = get_user(receiver)
-            if "wishes" in receiver_user and game_id in receiver_user["wishes"]:
-                wishes = receiver_user["wishes"][game_id]
-                if wishes.get("wish"):
-                    receiver_wishes += f"\n{EMOJI['wish']} <b>Хочет получить:</b>\n{wishes['wish']}\n"
-                if wishes.get("not_wish"):
-                    receiver_wishes += f"\n{EMOJI['not_wish']} <b>Не хочет получать:</b>\n{wishes['not_wish']}\n"
+            wishes = get_wishes(game, receiver)
+            if wishes.get("wish"):
+                receiver_wishes += f"\n{EMOJI['wish']} <b>Хочет получить:</b>\n{wishes['wish']}\n"
+            if wishes.get("not_wish"):
+                receiver_wishes += f"\n{EMOJI['not_wish']} <b>Не хочет получать:</b>\n{wishes['not_wish']}\n"
             
             message_text = (
                 f"{EMOJI['gift']} <b>Твой Тайный Санта!</b>\n\n"
                 f"{EMOJI['star']} <b>Твой получатель:</b> {receiver_mention}\n"
-                f"{EMOJI['money']} <b>Сумма подарка:</b> {game['amount']} ₽\n"
-                f"{EMOJI['tree']} <b>Игра:</b> {escape_markdown(game['name'])}"
+                f"{EMOJI['money']} <b>Сумма подарка:</b> {game.amount} ₽\n"
+                f"{EMOJI['tree']} <b>Игра:</b> {escape_markdown(game.name)}"
             )
             
             if receiver_wishes:
@@ -873,47 +2399,24 @@ async def start_game_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Узнай интересы получателя и прояви креативность!\n\n"
                 f"Счастливого Рождества! 🎄"
             )
-            
-            await context.bot.send_message(
-                giver,
-                message_text,
-                parse_mode="HTML",
-                disable_web_page_preview=True
-            )
-            success_count += 1
-        except Exception as e:
-            print(f"Ошибка отправки сообщения {giver}: {e}")
-    
-    try:
+            enqueue_message(giver, message_text, group)
+        
         pairs_list = f"{EMOJI['mail']} <b>Полный список пар (только для тебя):</b>\n\n"
         for giver, receiver in pairs.items():
-            try:
-                giver_info = await context.bot.get_chat(giver)
-                receiver_info = await context.bot.get_chat(receiver)
-                giver_mention = get_user_html_mention(giver, giver_info)
-                receiver_mention = get_user_html_mention(receiver, receiver_info)
-                
+            if profiles.get(giver) and profiles.get(receiver):
+                giver_mention = get_user_html_mention(giver, profiles[giver])
+                receiver_mention = get_user_html_mention(receiver, profiles[receiver])
                 pairs_list += f"• {giver_mention} → {receiver_mention}\n"
-            except:
-                pairs_list += f"• Игрок {giver[:4]}... → Игрок {receiver[:4]}...\n"
+            else:
+                pairs_list += f"• Игрок {str(giver)[:4]}... → Игрок {str(receiver)[:4]}...\n"
+        enqueue_message(game.owner, pairs_list, group)
         
-        await context.bot.send_message(
-            game["owner"],
-            pairs_list,
-            parse_mode="HTML",
-            disable_web_page_preview=True
-        )
-    except Exception as e:
-        print(f"Ошибка отправки списка пар организатору: {e}")
-    
-    for uid in game["players"]:
-        user = get_user(uid)
-        if "wishes" not in user or game_id not in user["wishes"] or not user["wishes"][game_id].get("wish"):
-            try:
-                await context.bot.send_message(
+        for uid in players:
+            if not get_wishes(game, uid).get("wish"):
+                enqueue_message(
                     uid,
                     f"{EMOJI['info']} <b>Напоминание о пожеланиях</b>\n\n"
-                    f"{EMOJI['tree']} Игра '{escape_markdown(game['name'])}' началась!\n\n"
+                    f"{EMOJI['tree']} Игра '{escape_markdown(game.name)}' началась!\n\n"
                     f"{EMOJI['santa']} К сожалению, ты не указал(а) свои пожелания для подарка.\n"
                     f"Твой Тайный Санта не будет знать, что тебе подарить.\n\n"
                     f"{EMOJI['wish']} <b>Что можно сделать:</b>\n"
@@ -921,60 +2424,121 @@ async def start_game_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"• Расскажи о своих интересах и предпочтениях\n"
                     f"• Предложи идеи для подарка\n\n"
                     f"Удачного обмена подарками! 🎁",
-                    parse_mode="HTML"
+                    group,
                 )
-            except:
-                pass
+        
+        game.pairs = pairs
+        game.started = True
+        safe_save("draw", games=[game_id])
+        saved = await flush_and_wait()
     
-    await query.edit_message_text(
-        f"{EMOJI['check']} <b>Распределение проведено!</b>\n\n"
-        f"Участникам отправлены сообщения с их получателями.\n"
-        f"Тебе отправлен полный список пар.\n\n"
-        f"{EMOJI['lock']} <b>Игра завершена и удалена из списка активных.</b>",
-        parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
-            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
-        ])
-    )
-
-async def delete_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    game_id = query.data.split("_")[1]
-    game = storage["games"].get(game_id)
-    
-    if not game:
-        await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
+    if not saved:
+        # Пачка вернётся в очередь записи; сообщения уйдут только после того, как она запишется
+        await query.edit_message_text(
+            f"{EMOJI['cross']} <b>Не удалось сохранить распределение</b>\n\n"
+            f"Сообщения участникам будут отправлены, как только запись на диск пройдёт успешно. "
+            f"Если бот перезапустится раньше, распределение нужно будет провести заново.",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
+            ])
+        )
         return
     
-    if query.from_user.id != int(game["owner"]):
-        await query.answer(f"{EMOJI['cross']} Только создатель игры может её удалить!", show_alert=True)
-        return
+    finished_games.append(game_id)
+    
+    await query.edit_message_text(
+        f"{EMOJI['santa']} <b>Распределение проведено!</b>\n\n"
+        f"⏳ Рассылаем сообщения участникам...",
+        parse_mode="HTML"
+    )
     
-    for uid in game["players"]:
-        if uid != str(query.from_user.id):
+    # Обработчик не ждёт рассылки: прогресс обновляет фоновая задача
+    task = asyncio.create_task(report_draw_progress(query, game_id, group))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+background_tasks = set()
+
+async def report_draw_progress(query, game_id, group):
+    """Обновляет сообщение создателя, пока очередь рассылки игры не опустеет"""
+    reported = None
+    while True:
+        counts = outbox_status(group)
+        total = sum(counts.values())
+        if not counts["pending"]:
+            break
+        done = total - counts["pending"]
+        if done != reported:
+            reported = done
             try:
-                await context.bot.send_message(
-                    uid,
-                    f"{EMOJI['info']} <b>Игра удалена</b>\n\n"
-                    f"{EMOJI['tree']} Игра '{escape_markdown(game['name'])}' была удалена создателем.",
+                await query.edit_message_text(
+                    f"{EMOJI['santa']} <b>Распределение проведено!</b>\n\n"
+                    f"⏳ Рассылаем сообщения участникам: {done}/{total}",
                     parse_mode="HTML"
                 )
-            except:
-                pass
+            except Exception as e:
+                print(f"Ошибка обновления прогресса рассылки: {e}")
+        await asyncio.sleep(DRAW_PROGRESS_INTERVAL)
+    
+    print(f"📨 Рассылка по игре {game_id}: доставлено {counts['sent']} из {total}")
+    
+    failed_note = ""
+    if counts["failed"] or counts["skipped"]:
+        failed_note = f"{EMOJI['info']} Не удалось доставить сообщений: {counts['failed'] + counts['skipped']}\n\n"
+    
+    try:
+        await query.edit_message_text(
+            f"{EMOJI['check']} <b>Распределение проведено!</b>\n\n"
+            f"Участникам отправлены сообщения с их получателями.\n"
+            f"Тебе отправлен полный список пар.\n\n"
+            f"{failed_note}"
+            f"{EMOJI['lock']} <b>Игра завершена и удалена из списка активных.</b>",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
+                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
+            ])
+        )
+    except Exception as e:
+        print(f"Ошибка обновления прогресса рассылки: {e}")
+
+async def delete_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    storage["games"].pop(game_id, None)
-    safe_save()
+    game_id = context.args[0]
+    
+    # Игра удаляется под блокировкой, уведомления уходят через очередь сообщений
+    async with game_lock(game_id):
+        game = storage["games"].get(game_id)
+        
+        if not game:
+            await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
+            return
+        
+        if query.from_user.id != game.owner:
+            await query.answer(f"{EMOJI['cross']} Только создатель игры может её удалить!", show_alert=True)
+            return
+        
+        async with users_lock(game.players):
+            touched_users = remove_game(game_id)
+            for uid in game.players:
+                if uid != query.from_user.id:
+                    enqueue_message(
+                        uid,
+                        f"{EMOJI['info']} <b>Игра удалена</b>\n\n"
+                        f"{EMOJI['tree']} Игра '{escape_markdown(game.name)}' была удалена создателем.",
+                    )
+            safe_save("delete_game", games=[game_id], users=touched_users)
     
     await query.edit_message_text(
         f"{EMOJI['check']} <b>Игра удалена</b>\n\n"
-        f"Игра '{escape_markdown(game['name'])}' успешно удалена.",
+        f"Игра '{escape_markdown(game.name)}' успешно удалена.",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
-            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+            [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
+            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
         ])
     )
 
@@ -982,27 +2546,25 @@ async def wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[1]
+    game_id = context.args[0]
     game = storage["games"].get(game_id)
     
     if not game:
         await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
         return
     
-    user_id = str(query.from_user.id)
+    user_id = query.from_user.id
     
-    if user_id not in game["players"]:
+    if user_id not in game.players:
         await query.answer(f"{EMOJI['cross']} Ты не участник этой игры!", show_alert=True)
         return
     
-    user = get_user(user_id)
-    
-    current_wishes = user.get("wishes", {}).get(game_id, {})
+    current_wishes = get_wishes(game, user_id)
     wish_text = current_wishes.get("wish", "")
     not_wish_text = current_wishes.get("not_wish", "")
     
     if wish_text or not_wish_text:
-        game_name = escape_markdown(game["name"])
+        game_name = escape_markdown(game.name)
         text = f"{EMOJI['preferences']} <b>Твои пожелания для игры:</b>\n\n"
         text += f"{EMOJI['tree']} <b>{game_name}</b>\n\n"
         
@@ -1019,10 +2581,10 @@ async def wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text += f"\n{EMOJI['info']} Эти пожелания увидит твой Тайный Санта после распределения."
         
         keyboard = [
-            [InlineKeyboardButton(f"{EMOJI['edit']} Изменить пожелания", callback_data=f"edit_wish_{game_id}")],
-            [InlineKeyboardButton(f"{EMOJI['check']} Оставить как есть", callback_data=f"game_{game_id}")],
-            [InlineKeyboardButton(f"{EMOJI['trash']} Удалить пожелания", callback_data=f"delete_wish_{game_id}")],
-            [InlineKeyboardButton(f"{EMOJI['back']} Назад к игре", callback_data=f"game_{game_id}")]
+            [InlineKeyboardButton(f"{EMOJI['edit']} Изменить пожелания", callback_data=pack_callback("edit_wish", game_id))],
+            [InlineKeyboardButton(f"{EMOJI['check']} Оставить как есть", callback_data=pack_callback("game", game_id))],
+            [InlineKeyboardButton(f"{EMOJI['trash']} Удалить пожелания", callback_data=pack_callback("delete_wish", game_id))],
+            [InlineKeyboardButton(f"{EMOJI['back']} Назад к игре", callback_data=pack_callback("game", game_id))]
         ]
         
         await query.edit_message_text(
@@ -1031,13 +2593,12 @@ async def wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="HTML"
         )
     else:
-        user["state"] = f"wait_wish_want_{game_id}"
-        safe_save()
+        conversations.get(user_id).update(state="wait_wish_want", tmp_game_id=game_id)
         
         await query.edit_message_text(
             f"{EMOJI['wish']} <b>Укажи свои пожелания для подарка</b>\n\n"
-            f"{EMOJI['tree']} Игра: {escape_markdown(game['name'])}\n"
-            f"{EMOJI['money']} Бюджет: {game['amount']} ₽\n\n"
+            f"{EMOJI['tree']} Игра: {escape_markdown(game.name)}\n"
+            f"{EMOJI['money']} Бюджет: {game.amount} ₽\n\n"
             f"Напиши, что бы ты хотел(а) получить:\n\n"
             f"{EMOJI['info']} Примеры:\n"
             f"• Книга по программированию\n"
@@ -1047,7 +2608,7 @@ async def wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Можно написать несколько пунктов.",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
             ])
         )
 
@@ -1055,21 +2616,19 @@ async def edit_wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[2]
+    game_id = context.args[0]
     game = storage["games"].get(game_id)
     
     if not game:
         await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
         return
     
-    user_id = str(query.from_user.id)
-    user = get_user(user_id)
-    user["state"] = f"wait_wish_want_{game_id}"
-    safe_save()
+    user_id = query.from_user.id
+    conversations.get(user_id).update(state="wait_wish_want", tmp_game_id=game_id)
     
     await query.edit_message_text(
         f"{EMOJI['edit']} <b>Изменение пожеланий</b>\n\n"
-        f"{EMOJI['tree']} Игра: {escape_markdown(game['name'])}\n\n"
+        f"{EMOJI['tree']} Игра: {escape_markdown(game.name)}\n\n"
         f"Напиши, что бы ты хотел(а) получить:\n\n"
         f"{EMOJI['info']} Примеры:\n"
         f"• Книга по программированию\n"
@@ -1079,7 +2638,7 @@ async def edit_wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Можно написать несколько пунктов.",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
+            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
         ])
     )
 
@@ -1087,19 +2646,19 @@ async def delete_wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[2]
-    game = storage["games"].get(game_id)
-    
-    if not game:
-        await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
-        return
-    
-    user_id = str(query.from_user.id)
-    user = get_user(user_id)
+    game_id = context.args[0]
+    user_id = query.from_user.id
     
-    if "wishes" in user and game_id in user["wishes"]:
-        del user["wishes"][game_id]
-        safe_save()
+    # Пожелания лежат в записи игры, которую параллельно меняют join/kick
+    async with game_lock(game_id):
+        game = storage["games"].get(game_id)
+        
+        if not game:
+            await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
+            return
+        
+        if game.wishes.pop(user_id, None) is not None:
+            safe_save("wish", games=[game_id])
     
     await query.answer("✅ Пожелания удалены", show_alert=True)
     await wish_cb(update, context)
@@ -1108,21 +2667,21 @@ async def skip_not_wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    game_id = query.data.split("_")[3]
-    game = storage["games"].get(game_id)
-    
-    if not game:
-        await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
-        return
-    
-    user_id = str(query.from_user.id)
-    user = get_user(user_id)
+    game_id = context.args[0]
+    user_id = query.from_user.id
     
-    user.setdefault("wishes", {}).setdefault(game_id, {})["not_wish"] = ""
-    user["state"] = None
-    safe_save()
+    async with game_lock(game_id):
+        game = storage["games"].get(game_id)
+        
+        if not game:
+            await query.answer(f"{EMOJI['cross']} Игра не найдена!", show_alert=True)
+            return
+        
+        set_wish(game, user_id, "not_wish", "")
+        conversations.clear(user_id)
+        safe_save("wish", games=[game_id])
     
-    game_name = escape_markdown(game["name"])
+    game_name = escape_markdown(game.name)
     
     await query.edit_message_text(
         f"{EMOJI['check']} <b>Пожелания сохранены!</b>\n\n"
@@ -1130,8 +2689,8 @@ async def skip_not_wish_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Теперь твой Тайный Санта будет знать, что ты хочешь получить в подарок! 🎁",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['back']} К игре", callback_data=f"game_{game_id}")],
-            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+            [InlineKeyboardButton(f"{EMOJI['back']} К игре", callback_data=pack_callback("game", game_id))],
+            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
         ])
     )
 
@@ -1139,13 +2698,7 @@ async def main_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    user = get_user(query.from_user.id)
-    user["state"] = None
-    if "tmp_name" in user:
-        del user["tmp_name"]
-    if "tmp_game_id" in user:
-        del user["tmp_game_id"]
-    safe_save()
+    conversations.clear(query.from_user.id)
 
     welcome_text = (
         f"{EMOJI['gift']} <b>Тайный Санта</b>\n\n"
@@ -1154,9 +2707,9 @@ async def main_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     keyboard = [
-        [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data="create_game")],
-        [InlineKeyboardButton(f"{EMOJI['join']} Присоединиться", callback_data="join_game")],
-        [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
+        [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data=pack_callback("create_game"))],
+        [InlineKeyboardButton(f"{EMOJI['join']} Присоединиться", callback_data=pack_callback("join_game"))],
+        [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
         [InlineKeyboardButton(f"{EMOJI['help']} FAQ и инструкции", url=FAQ_CHANNEL_LINK)],
     ]
 
@@ -1167,311 +2720,426 @@ async def main_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # ТЕКСТОВЫЙ ОБРАБОТЧИК
-async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.message.from_user.id)
-    user = get_user(user_id)
+async def game_name_text(update: Update, context: ContextTypes.DEFAULT_TYPE, conv):
+    """Название новой игры"""
+    name = update.message.text.strip()
+    if len(name) < 2:
+        await update.message.reply_text(f"{EMOJI['cross']} Слишком короткое название. Минимум 2 символа:")
+        return
 
-    if user.get("state") == "wait_game_name":
-        name = update.message.text.strip()
-        if len(name) < 2:
-            await update.message.reply_text(f"{EMOJI['cross']} Слишком короткое название. Минимум 2 символа:")
-            return
+    conv["tmp_name"] = name
+    conv["state"] = "wait_game_amount"
 
-        user["tmp_name"] = name
-        user["state"] = "wait_game_amount"
-        safe_save()
+    await update.message.reply_text(
+        f"{EMOJI['money']} Сумма подарка\n\nВведи сумму в рублях:\n\n"
+        f"{EMOJI['info']} Используй /cancel для отмены",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
+        ])
+    )
 
+async def game_amount_text(update: Update, context: ContextTypes.DEFAULT_TYPE, conv):
+    """Сумма новой игры — игра создаётся"""
+    user_id = update.message.from_user.id
+    if "tmp_name" not in conv:
         await update.message.reply_text(
-            f"{EMOJI['money']} Сумма подарка\n\nВведи сумму в рублях:\n\n"
-            f"{EMOJI['info']} Используй /cancel для отмены",
+            f"{EMOJI['cross']} Ошибка. Начни заново: /menu",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
             ])
         )
+        conversations.clear(user_id)
         return
 
-    if user.get("state") == "wait_game_amount":
-        if "tmp_name" not in user:
+    try:
+        text = update.message.text.strip().replace(" ", "").replace(",", ".")
+        amount = float(text)
+
+        if amount <= 0:
             await update.message.reply_text(
-                f"{EMOJI['cross']} Ошибка. Начни заново: /menu",
+                f"{EMOJI['cross']} Сумма должна быть больше 0. Попробуй снова:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
+                    [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
                 ])
             )
-            user["state"] = None
-            safe_save()
             return
 
-        try:
-            text = update.message.text.strip().replace(" ", "").replace(",", ".")
-            amount = float(text)
-
-            if amount <= 0:
-                await update.message.reply_text(
-                    f"{EMOJI['cross']} Сумма должна быть больше 0. Попробуй снова:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
-                    ])
-                )
-                return
-
-            if amount > 1000000:
-                await update.message.reply_text(
-                    f"{EMOJI['cross']} Максимум 1,000,000 ₽. Попробуй снова:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
-                    ])
-                )
-                return
-
-        except ValueError:
+        if amount > 1000000:
             await update.message.reply_text(
-                f"{EMOJI['cross']} Это не похоже на число. Пример: 1000 или 1500.50",
+                f"{EMOJI['cross']} Максимум 1,000,000 ₽. Попробуй снова:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
+                    [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
                 ])
             )
             return
 
-        game_id = gen_game_id()
+    except ValueError:
+        await update.message.reply_text(
+            f"{EMOJI['cross']} Это не похоже на число. Пример: 1000 или 1500.50",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
+            ])
+        )
+        return
+
+    game_id = gen_game_id()
 
-        if amount.is_integer():
-            amount_str = str(int(amount))
-        else:
-            amount_str = f"{amount:.2f}".rstrip('0').rstrip('.')
-
-        game_name = escape_markdown(user["tmp_name"])
-
-        storage["games"][game_id] = {
-            "id": game_id,
-            "name": user["tmp_name"],
-            "amount": amount_str,
-            "owner": user_id,
-            "players": [user_id],
-            "started": False,
-            "pairs": {}
-        }
+    if amount.is_integer():
+        amount_str = str(int(amount))
+    else:
+        amount_str = f"{amount:.2f}".rstrip('0').rstrip('.')
+
+    game_name = escape_markdown(conv["tmp_name"])
 
-        del user["tmp_name"]
-        user["state"] = None
-        user.setdefault("games", []).append(game_id)
-        safe_save()
-
-        invite_link = f"https://t.me/{context.bot.username}?start={game_id}"
-
-        text = (
-            f"{EMOJI['tree']}✨ <b>Игра «{game_name}» готова!</b>\n\n"
-            f"{EMOJI['money']} <b>Сумма:</b> {amount_str} ₽\n"
-            f"{EMOJI['users']} <b>Участников:</b> 1 (включая тебя)\n\n"
-            f"{EMOJI['link']} <b>Ссылка для друзей:</b>\n"
-            f"{invite_link}\n\n"
-            f"{EMOJI['snowflake']} Отправь ссылку друзьям!\n"
-            f"{EMOJI['santa']} Когда все соберутся — запусти распределение!"
+    async with users_lock([user_id]):
+        storage["games"][game_id] = Game(
+            id=game_id,
+            name=conv["tmp_name"],
+            amount=amount_str,
+            owner=user_id,
+            players=[user_id],
         )
+        get_user(user_id).games.add(game_id)
+        safe_save("create_game", games=[game_id], users=[user_id])
+    conversations.clear(user_id)
 
-        keyboard = [
-            [
-                InlineKeyboardButton(f"{EMOJI['link']} Пригласить", callback_data=f"invite_{game_id}"),
-                InlineKeyboardButton(f"{EMOJI['users']} Участники", callback_data=f"players_{game_id}")
-            ],
-            [InlineKeyboardButton(f"{EMOJI['play']} Запустить распределение", callback_data=f"start_game_{game_id}")],
-            [InlineKeyboardButton(f"{EMOJI['wish']} Указать пожелания", callback_data=f"wish_{game_id}")],
-            [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
-            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
-        ]
+    invite_link = f"https://t.me/{context.bot.username}?start={game_id}"
+
+    text = (
+        f"{EMOJI['tree']}✨ <b>Игра «{game_name}» готова!</b>\n\n"
+        f"{EMOJI['money']} <b>Сумма:</b> {amount_str} ₽\n"
+        f"{EMOJI['users']} <b>Участников:</b> 1 (включая тебя)\n\n"
+        f"{EMOJI['link']} <b>Ссылка для друзей:</b>\n"
+        f"{invite_link}\n\n"
+        f"{EMOJI['snowflake']} Отправь ссылку друзьям!\n"
+        f"{EMOJI['santa']} Когда все соберутся — запусти распределение!"
+    )
+
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{EMOJI['link']} Пригласить", callback_data=pack_callback("invite", game_id)),
+            InlineKeyboardButton(f"{EMOJI['users']} Участники", callback_data=pack_callback("players", game_id))
+        ],
+        [InlineKeyboardButton(f"{EMOJI['play']} Запустить распределение", callback_data=pack_callback("start_game", game_id))],
+        [InlineKeyboardButton(f"{EMOJI['wish']} Указать пожелания", callback_data=pack_callback("wish", game_id))],
+        [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
+        [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
+    ]
+
+    await update.message.reply_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
+
+async def join_code_text(update: Update, context: ContextTypes.DEFAULT_TYPE, conv):
+    """Код вместо ссылки-приглашения: объясняем, как присоединиться"""
+    user_id = update.message.from_user.id
+    await update.message.reply_text(
+        f"{EMOJI['info']} <b>Для присоединения к игре нужна ссылка от организатора</b>\n\n"
+        f"{EMOJI['santa']} Попроси у организатора игры ссылку-приглашение и просто перейди по ней!\n\n"
+        f"Если ты организатор — создай новую игру или зайди в свои существующие игры.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data=pack_callback("create_game"))],
+            [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data=pack_callback("my_games"))],
+            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
+        ])
+    )
+    conversations.clear(user_id)
 
+async def new_amount_text(update: Update, context: ContextTypes.DEFAULT_TYPE, conv):
+    """Новая сумма существующей игры"""
+    user_id = update.message.from_user.id
+    game_id = conv["tmp_game_id"]
+
+    if game_id not in storage["games"]:
         await update.message.reply_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="HTML"
+            f"{EMOJI['cross']} Игра не найдена.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
+            ])
         )
+        conversations.clear(user_id)
         return
 
-    if user.get("state") == "wait_join_code":
+    game = storage["games"][game_id]
+
+    if user_id != game.owner:
         await update.message.reply_text(
-            f"{EMOJI['info']} <b>Для присоединения к игре нужна ссылка от организатора</b>\n\n"
-            f"{EMOJI['santa']} Попроси у организатора игры ссылку-приглашение и просто перейди по ней!\n\n"
-            f"Если ты организатор — создай новую игру или зайди в свои существующие игры.",
-            parse_mode="HTML",
+            f"{EMOJI['cross']} Только создатель игры может менять сумму.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['create']} Создать игру", callback_data="create_game")],
-                [InlineKeyboardButton(f"{EMOJI['list']} Мои игры", callback_data="my_games")],
-                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
             ])
         )
-        user["state"] = None
-        safe_save()
+        conversations.clear(user_id)
         return
 
-    if user.get("state") and user["state"].startswith("wait_new_amount_"):
-        game_id = user["state"].split("_")[-1]
-
-        if game_id not in storage["games"]:
-            await update.message.reply_text(
-                f"{EMOJI['cross']} Игра не найдена.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            user["state"] = None
-            safe_save()
-            return
-
-        game = storage["games"][game_id]
+    try:
+        text = update.message.text.strip().replace(" ", "").replace(",", ".")
+        amount = float(text)
 
-        if user_id != game["owner"]:
+        if amount <= 0:
             await update.message.reply_text(
-                f"{EMOJI['cross']} Только создатель игры может менять сумму.",
+                f"{EMOJI['cross']} Сумма должна быть больше 0. Попробуй снова:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
+                    [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
                 ])
             )
-            user["state"] = None
-            safe_save()
             return
 
-        try:
-            text = update.message.text.strip().replace(" ", "").replace(",", ".")
-            amount = float(text)
+    except ValueError:
+        await update.message.reply_text(
+            f"{EMOJI['cross']} Это не похоже на число. Пример: 1000 или 1500.50",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
+            ])
+        )
+        return
 
-            if amount <= 0:
-                await update.message.reply_text(
-                    f"{EMOJI['cross']} Сумма должна быть больше 0. Попробуй снова:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
-                    ])
-                )
-                return
+    if amount.is_integer():
+        amount_str = str(int(amount))
+    else:
+        amount_str = f"{amount:.2f}".rstrip('0').rstrip('.')
 
-        except ValueError:
-            await update.message.reply_text(
-                f"{EMOJI['cross']} Это не похоже на число. Пример: 1000 или 1500.50",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
-                ])
-            )
-            return
+    conversations.clear(user_id)
+    async with game_lock(game_id):
+        # Пока вводилась сумма, игру могли изменить или удалить
+        game = storage["games"].get(game_id)
+        if game:
+            game.amount = amount_str
+            safe_save("amount", games=[game_id])
+    if not game:
+        await update.message.reply_text(f"{EMOJI['cross']} Игра не найдена.")
+        return
 
-        if amount.is_integer():
-            amount_str = str(int(amount))
-        else:
-            amount_str = f"{amount:.2f}".rstrip('0').rstrip('.')
+    game_name = escape_markdown(game.name)
 
-        game["amount"] = amount_str
-        user["state"] = None
-        safe_save()
+    await update.message.reply_text(
+        f"{EMOJI['check']} <b>Сумма обновлена!</b>\n\n"
+        f"{EMOJI['tree']} <b>{game_name}</b>\n"
+        f"{EMOJI['money']} <b>Бюджет:</b> {game.amount} ₽\n"
+        f"{EMOJI['users']} <b>Участников:</b> {len(game.players)}",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{EMOJI['back']} К игре", callback_data=pack_callback("game", game_id))],
+            [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
+        ])
+    )
 
-        game_name = escape_markdown(game["name"])
+async def wish_want_text(update: Update, context: ContextTypes.DEFAULT_TYPE, conv):
+    """Что участник хочет получить"""
+    user_id = update.message.from_user.id
+    game_id = conv["tmp_game_id"]
 
+    if game_id not in storage["games"]:
         await update.message.reply_text(
-            f"{EMOJI['check']} <b>Сумма обновлена!</b>\n\n"
-            f"{EMOJI['tree']} <b>{game_name}</b>\n"
-            f"{EMOJI['money']} <b>Бюджет:</b> {game['amount']} ₽\n"
-            f"{EMOJI['users']} <b>Участников:</b> {len(game['players'])}",
-            parse_mode="HTML",
+            f"{EMOJI['cross']} Игра не найдена.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['back']} К игре", callback_data=f"game_{game_id}")],
-                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
             ])
         )
+        conversations.clear(user_id)
         return
 
-    if user.get("state") and user["state"].startswith("wait_wish_want_"):
-        game_id = user["state"].split("_")[-1]
+    wish_text = update.message.text.strip()
+    if len(wish_text) > 500:
+        await update.message.reply_text(
+            f"{EMOJI['cross']} Слишком длинный текст. Максимум 500 символов.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
+            ])
+        )
+        return
 
-        if game_id not in storage["games"]:
-            await update.message.reply_text(
-                f"{EMOJI['cross']} Игра не найдена.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            user["state"] = None
-            safe_save()
-            return
+    async with game_lock(game_id):
+        game = storage["games"].get(game_id)
+        if game:
+            set_wish(game, user_id, "wish", wish_text)
+            safe_save("wish", games=[game_id])
+    if not game:
+        conversations.clear(user_id)
+        await update.message.reply_text(f"{EMOJI['cross']} Игра не найдена.")
+        return
+    conv["state"] = "wait_wish_not"
 
-        wish_text = update.message.text.strip()
-        if len(wish_text) > 500:
-            await update.message.reply_text(
-                f"{EMOJI['cross']} Слишком длинный текст. Максимум 500 символов.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            return
+    await update.message.reply_text(
+        f"{EMOJI['check']} <b>Отлично!</b> А теперь напиши, что бы ты НЕ хотел(а) получить:\n\n"
+        f"{EMOJI['info']} Примеры:\n"
+        f"• Не нужно дарить сладости\n"
+        f"• Не люблю красный цвет\n"
+        f"• Не дарите носки, пожалуйста\n\n"
+        f"Можно написать несколько пунктов или оставить поле пустым.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{EMOJI['check']} Пропустить", callback_data=pack_callback("skip_not_wish", game_id))],
+            [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data=pack_callback("main_menu"))]
+        ])
+    )
 
-        user.setdefault("wishes", {}).setdefault(game_id, {})["wish"] = wish_text
-        user["state"] = f"wait_wish_not_{game_id}"
-        safe_save()
+async def wish_not_text(update: Update, context: ContextTypes.DEFAULT_TYPE, conv):
+    """Чего участник не хочет получить"""
+    user_id = update.message.from_user.id
+    game_id = conv["tmp_game_id"]
 
+    if game_id not in storage["games"]:
         await update.message.reply_text(
-            f"{EMOJI['check']} <b>Отлично!</b> А теперь напиши, что бы ты НЕ хотел(а) получить:\n\n"
-            f"{EMOJI['info']} Примеры:\n"
-            f"• Не нужно дарить сладости\n"
-            f"• Не люблю красный цвет\n"
-            f"• Не дарите носки, пожалуйста\n\n"
-            f"Можно написать несколько пунктов или оставить поле пустым.",
-            parse_mode="HTML",
+            f"{EMOJI['cross']} Игра не найдена.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['check']} Пропустить", callback_data=f"skip_not_wish_{game_id}")],
-                [InlineKeyboardButton(f"{EMOJI['home']} Отмена", callback_data="main_menu")]
+                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
             ])
         )
+        conversations.clear(user_id)
         return
 
-    if user.get("state") and user["state"].startswith("wait_wish_not_"):
-        game_id = user["state"].split("_")[-1]
+    not_wish_text = update.message.text.strip()
+    if len(not_wish_text) > 500:
+        await update.message.reply_text(
+            f"{EMOJI['cross']} Слишком длинный текст. Максимум 500 символов.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
+            ])
+        )
+        return
 
-        if game_id not in storage["games"]:
-            await update.message.reply_text(
-                f"{EMOJI['cross']} Игра не найдена.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            user["state"] = None
-            safe_save()
-            return
+    conversations.clear(user_id)
+    async with game_lock(game_id):
+        game = storage["games"].get(game_id)
+        if game:
+            set_wish(game, user_id, "not_wish", not_wish_text)
+            safe_save("wish", games=[game_id])
+    if not game:
+        await update.message.reply_text(f"{EMOJI['cross']} Игра не найдена.")
+        return
 
-        not_wish_text = update.message.text.strip()
-        if len(not_wish_text) > 500:
-            await update.message.reply_text(
-                f"{EMOJI['cross']} Слишком длинный текст. Максимум 500 символов.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
-                ])
-            )
-            return
+    game_name = escape_markdown(game.name)
 
-        user.setdefault("wishes", {}).setdefault(game_id, {})["not_wish"] = not_wish_text
-        user["state"] = None
-        safe_save()
+    await update.message.reply_text(
+        f"{EMOJI['check']} <b>Пожелания сохранены!</b>\n\n"
+        f"{EMOJI['tree']} <b>{game_name}</b>\n\n"
+        f"Теперь твой Тайный Санта будет знать, что ты хочешь и чего не хочешь получить в подарок! 🎁",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{EMOJI['back']} К игре", callback_data=pack_callback("game", game_id))],
+            [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data=pack_callback("main_menu"))]
+        ])
+    )
 
-        game = storage["games"][game_id]
-        game_name = escape_markdown(game["name"])
+# Шаг диалога → обработчик текста; состояние без обработчика — подсказка про меню
+TEXT_STATES = {
+    "wait_game_name": game_name_text,
+    "wait_game_amount": game_amount_text,
+    "wait_join_code": join_code_text,
+    "wait_new_amount": new_amount_text,
+    "wait_wish_want": wish_want_text,
+    "wait_wish_not": wish_not_text,
+}
 
-        await update.message.reply_text(
-            f"{EMOJI['check']} <b>Пожелания сохранены!</b>\n\n"
-            f"{EMOJI['tree']} <b>{game_name}</b>\n\n"
-            f"Теперь твой Тайный Санта будет знать, что ты хочешь и чего не хочешь получить в подарок! 🎁",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{EMOJI['back']} К игре", callback_data=f"game_{game_id}")],
-                [InlineKeyboardButton(f"{EMOJI['home']} Главное меню", callback_data="main_menu")]
-            ])
-        )
+async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conv = conversations.get(update.message.from_user.id)
+    handler = TEXT_STATES.get(conv["state"])
+    if handler is not None:
+        await handler(update, context, conv)
         return
 
     await update.message.reply_text(
         f"{EMOJI['info']} Используй кнопки меню для навигации.",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data="main_menu")]
+            [InlineKeyboardButton(f"{EMOJI['home']} Меню", callback_data=pack_callback("main_menu"))]
         ])
     )
 
+# Действие кнопки → (обработчик, число аргументов); аргументы обработчик берёт из context.args
+CALLBACK_ROUTES = {
+    "main_menu": (main_menu_cb, 0),
+    "create_game": (create_game_cb, 0),
+    "join_game": (join_game_cb, 0),
+    "my_games": (my_games_cb, 0),
+    "game": (game_details_cb, 1),
+    "invite": (invite_cb, 1),
+    "players": (players_cb, 1),
+    "kick": (kick_cb, 2),
+    "delete": (delete_cb, 1),
+    "edit_amount": (edit_amount_cb, 1),
+    "start_game": (start_game_cb, 1),
+    "wish": (wish_cb, 1),
+    "edit_wish": (edit_wish_cb, 1),
+    "delete_wish": (delete_wish_cb, 1),
+    "skip_not_wish": (skip_not_wish_cb, 1),
+}
+
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Все нажатия кнопок: callback_data разбирается один раз, обработчик — поиском в словаре"""
+    query = update.callback_query
+    action, args = parse_callback(query.data or "")
+    route = CALLBACK_ROUTES.get(action)
+    if route is None or len(args) != route[1]:
+        await query.answer(f"{EMOJI['info']} Кнопка устарела. Открой меню: /menu", show_alert=True)
+        return
+    handler, _ = route
+    context.args = args
+    await handler(update, context)
+
 # WEBHOOK & FASTAPI
 application = None
 
+def build_application():
+    """Приложение PTB со всеми обработчиками — общее для вебхука и long polling"""
+    bot_request = create_bot_request()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(bot_request)
+        .get_updates_request(bot_request)
+        .concurrent_updates(UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(send_scheduler)
+        .build()
+    )
+
+    application.add_handler(TypeHandler(Update, capture_profile), group=-1)
+    application.add_handler(CommandHandler("start", handle_start_with_param))
+    application.add_handler(CommandHandler("menu", menu_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CallbackQueryHandler(callback_router))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    return application
+
+
+# Типы обновлений, которые обрабатывает бот; их же просим у Telegram в set_webhook
+ALLOWED_UPDATES = ["message", "callback_query", "my_chat_member"]
+
+webhook_stats = collections.Counter()
+
+def is_handled_update(data):
+    """Решает по сырому JSON, дойдёт ли обновление до обработчиков, — до сборки объекта Update.
+
+    Сообщения без текста (стикеры, фото) ни один обработчик не принимает.
+    """
+    for kind in ALLOWED_UPDATES:
+        if kind in data:
+            return kind != "message" or "text" in data[kind]
+    return False
+
+def is_authorized(req):
+    """Запрос несёт секрет из set_webhook (без WEBHOOK_SECRET проверка не ведётся)"""
+    if not WEBHOOK_SECRET:
+        return True
+    token = req.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return True
+    webhook_stats["unauthorized"] += 1
+    return False
+
+async def register_webhook(bot):
+    if not WEBHOOK_URL:
+        return
+    await bot.set_webhook(WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET)
+    print(f"✅ Webhook установлен на {WEBHOOK_URL} (типы обновлений: {', '.join(ALLOWED_UPDATES)})")
+    if not WEBHOOK_SECRET:
+        print("⚠️  WEBHOOK_SECRET не задан: /webhook принимает запросы от кого угодно")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global application
@@ -1486,64 +3154,67 @@ async def lifespan(app: FastAPI):
             last_save_time = datetime.fromtimestamp(last_save).strftime("%Y-%m-%d %H:%M:%S")
             print(f"💾 Последнее сохранение: {last_save_time}")
 
-    removed = cleanup_finished_games()
-    if removed > 0:
-        print(f"🧹 Очищено завершенных игр при старте: {removed}")
+    # С общей базой оставшиеся с прошлого запуска игры чистит обработчик 0, новые — тот, кто их запустил
+    queued = queue_started_games() if WORKER_SLOT == 0 else 0
+    if queued > 0:
+        print(f"🧹 Завершенных игр в очереди на очистку: {queued}")
+    if outbox_pending:
+        print(f"📨 Неотправленных сообщений в очереди: {len(outbox_pending)}")
     
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    application.add_handler(CommandHandler("start", handle_start_with_param))
-    application.add_handler(CommandHandler("menu", menu_command))
-    application.add_handler(CommandHandler("cancel", cancel_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CallbackQueryHandler(create_game_cb, pattern="create_game"))
-    application.add_handler(CallbackQueryHandler(join_game_cb, pattern="join_game"))
-    application.add_handler(CallbackQueryHandler(my_games_cb, pattern="my_games"))
-    application.add_handler(CallbackQueryHandler(game_details_cb, pattern="game_"))
-    application.add_handler(CallbackQueryHandler(invite_cb, pattern="invite_"))
-    application.add_handler(CallbackQueryHandler(players_cb, pattern="players_"))
-    application.add_handler(CallbackQueryHandler(kick_cb, pattern="kick_"))
-    application.add_handler(CallbackQueryHandler(delete_cb, pattern="delete_"))
-    application.add_handler(CallbackQueryHandler(edit_amount_cb, pattern="edit_amount_"))
-    application.add_handler(CallbackQueryHandler(start_game_cb, pattern="start_game_"))
-    application.add_handler(CallbackQueryHandler(main_menu_cb, pattern="main_menu"))
-    application.add_handler(CallbackQueryHandler(wish_cb, pattern="wish_"))
-    application.add_handler(CallbackQueryHandler(edit_wish_cb, pattern="edit_wish_"))
-    application.add_handler(CallbackQueryHandler(delete_wish_cb, pattern="delete_wish_"))
-    application.add_handler(CallbackQueryHandler(skip_not_wish_cb, pattern="skip_not_wish_"))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    application = build_application()
 
     await application.initialize()
 
-    if WEBHOOK_URL:
-        await application.bot.set_webhook(WEBHOOK_URL)
-        print(f"✅ Webhook установлен на {WEBHOOK_URL}")
-
-    # Запускаем фоновый пинг для предотвращения сна
-    start_ping_loop()
-    
-    # Отмечаем, что пинг-система активна
-    if "_metadata" not in storage:
-        storage["_metadata"] = {}
-    storage["_metadata"]["ping_active"] = True
-    storage["_metadata"]["ping_started"] = time.time()
-    safe_save()
+    if RUN_MODE == "polling":
+        # Пока установлен вебхук, getUpdates не работает
+        await application.bot.delete_webhook()
+    elif RUN_MODE == "webhook":
+        await register_webhook(application.bot)
 
-    print(f"✅ Тайный Санта готов!")
+    # Фоновый пинг нужен только веб-серверу на засыпающем хостинге (обработчиков пингует процесс на PORT)
+    if RUN_MODE == "webhook":
+        start_ping_loop()
+        
+        # Отмечаем, что пинг-система активна
+        if "_metadata" not in storage:
+            storage["_metadata"] = {}
+        storage["_metadata"]["ping_active"] = True
+        storage["_metadata"]["ping_started"] = time.time()
+        safe_save("meta")
+
+    autosave_task = asyncio.create_task(autosave_loop())
+    cleanup_task = asyncio.create_task(cleanup_loop())
+    outbox_task = asyncio.create_task(outbox_loop(application.bot))
+    update_queue.start(application)
+    if RUN_MODE == "worker":
+        background_tasks.add(asyncio.create_task(changes_loop()))
+
+    print(f"✅ Тайный Санта готов!" if RUN_MODE != "worker" else f"✅ Обработчик {WORKER_SLOT} готов")
     print(f"📚 FAQ канал: {FAQ_CHANNEL_LINK}")
-    print(f"💾 Автосохранение: включено (бэкапы в {BACKUP_FILE})")
-    print(f"📡 Система предотвращения сна: ✅ активна (пинг каждые {PING_INTERVAL} сек)")
-
-    yield
+    save_mode = "сразу, база общая с другими обработчиками" if SHARED_STORAGE else f"интервал {SAVE_INTERVAL} сек"
+    print(f"💾 Автосохранение: включено ({save_mode}, бэкапы в {backend.backup_path})")
+    if RUN_MODE == "webhook":
+        print(f"📡 Система предотвращения сна: ✅ активна (пинг каждые {PING_INTERVAL} сек)")
 
-    print("🎄 Остановка бота...")
-    if safe_save():
-        print("💾 Данные успешно сохранены перед выключением")
-    
-    if application:
-        await application.shutdown()
-    print("✅ Бот остановлен")
+    try:
+        yield
+    finally:
+        print("🎄 Остановка бота...")
+        await update_queue.stop(UPDATE_DRAIN_TIMEOUT)
+        autosave_task.cancel()
+        cleanup_task.cancel()
+        outbox_task.cancel()
+        for task in background_tasks:
+            task.cancel()
+        requeue_failed_batches()
+        seen_updates.save()
+        if await flush_and_wait():
+            print("💾 Данные успешно сохранены перед выключением")
+        persistence_worker.stop()
+        
+        if application:
+            await application.shutdown()
+        print("✅ Бот остановлен")
 
 app = FastAPI(lifespan=lifespan)
 
@@ -1552,22 +3223,39 @@ async def webhook(req: Request):
     global application
 
     if not application:
-        return {"ok": False, "error": "Application not initialized"}, 500
+        return JSONResponse({"ok": False, "error": "Application not initialized"}, status_code=500)
+
+    if not is_authorized(req):
+        return JSONResponse({"ok": False, "error": "Forbidden"}, status_code=403)
+
+    try:
+        data = loads(await req.body())
+    except ValueError:
+        webhook_stats["invalid"] += 1
+        return JSONResponse({"ok": False, "error": "Invalid JSON"}, status_code=400)
+    webhook_stats["received"] += 1
+    if not isinstance(data, dict) or not is_handled_update(data):
+        webhook_stats["filtered"] += 1
+        return {"ok": True}
+    # Повторная доставка того же обновления: подтверждаем, но не выполняем ещё раз
+    if seen_updates.is_duplicate(data.get("update_id")):
+        return {"ok": True}
 
     try:
-        data = await req.json()
         update = Update.de_json(data, application.bot)
-        await application.process_update(update)
+        # Обработка — в фоне: долгий обработчик не держит запрос Telegram
+        if not update_queue.put(update):
+            return JSONResponse({"ok": False, "error": "Update queue is full"}, status_code=503)
+        seen_updates.add(update.update_id)
         return {"ok": True}
     except Exception as e:
         print(f"Ошибка в webhook: {e}")
-        return {"ok": False, "error": str(e)}, 500
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.get("/")
 async def health_check():
     """Основной эндпоинт для проверки работы и пинга"""
-    active_games = len([g for g in storage["games"].values() if not g.get("started")])
-    finished_games = len([g for g in storage["games"].values() if g.get("started")])
+    counts = storage_counts()
     
     last_save = storage.get("_metadata", {}).get("last_save", "неизвестно")
     if isinstance(last_save, (int, float)):
@@ -1580,17 +3268,18 @@ async def health_check():
     return {
         "status": "ok", 
         "message": "🎅 Тайный Санта работает",
-        "games_count": len(storage["games"]),
-        "active_games": active_games,
-        "finished_games": finished_games,
-        "users_count": len(storage["users"]),
+        "games_count": counts["games"],
+        "active_games": counts["active_games"],
+        "finished_games": counts["finished_games"],
+        "users_count": counts["users"],
         "last_save": last_save,
         "ping_system": "активна" if storage.get("_metadata", {}).get("ping_active") else "неактивна",
         "ping_started": ping_started,
         "ping_interval": PING_INTERVAL,
         "faq_channel": FAQ_CHANNEL_LINK,
-        "storage_file": STORAGE_FILE,
-        "backup_file": BACKUP_FILE if os.path.exists(BACKUP_FILE) else "не создан"
+        "storage_file": backend.path,
+        "storage_backend": backend.name,
+        "backup_file": backend.backup_path if os.path.exists(backend.backup_path) else "не создан"
     }
 
 @app.get("/ping")
@@ -1604,15 +3293,36 @@ async def ping_endpoint():
         "users_count": len(storage["users"])
     }
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Внутренние счётчики бота"""
+    return {
+        "storage_backend": backend.name,
+        "storage_cache": cache_stats(),
+        "conversations": len(conversations),
+        "profile_cache": profile_cache.stats(),
+        "outbox": dict(outbox_status()),
+        "webhook": dict(webhook_stats),
+        "seen_updates": seen_updates.stats(),
+        "update_queue": update_queue.stats(),
+        "send_scheduler": send_scheduler.stats(),
+        "shared_storage": {"worker": WORKER_SLOT, "locks": file_locks.stats()} if SHARED_STORAGE else None,
+        "bot_api": {
+            "pool_size": BOT_POOL_SIZE,
+            "methods": application.bot.request.stats() if application else {},
+        },
+    }
+
 @app.get("/backup")
 async def create_manual_backup():
     try:
-        if create_backup():
+        flush_storage()
+        if await asyncio.wrap_future(create_backup(rotate=True)):
             return {
                 "status": "ok",
                 "message": "✅ Ручной бэкап создан успешно",
-                "backup_file": BACKUP_FILE,
-                "backup_size": os.path.getsize(BACKUP_FILE) if os.path.exists(BACKUP_FILE) else 0
+                "backup_file": backend.backup_path,
+                "backup_size": os.path.getsize(backend.backup_path) if os.path.exists(backend.backup_path) else 0
             }
         else:
             return {
@@ -1625,13 +3335,226 @@ async def create_manual_backup():
             "message": f"❌ Ошибка: {str(e)}"
         }
 
+# ========== НЕСКОЛЬКО ПРОЦЕССОВ ==========
+
+def worker_socket(slot):
+    return os.path.join(WORKER_SOCKET_DIR, f"worker-{slot}.sock")
+
+def route_update(data):
+    """Номер обработчика для обновления: все обновления пользователя попадают в один процесс"""
+    for kind in ALLOWED_UPDATES:
+        if kind in data:
+            sender = data[kind].get("from") or data[kind].get("chat") or {}
+            return sender.get("id", 0) % WORKERS
+    return 0
+
+class WorkerPool:
+    """Процессы-обработчики: запуск, перезапуск упавших и пересылка им обновлений через unix-сокеты.
+
+    Обработчик — тот же main.py с RUN_MODE=worker: полноценное приложение
+    со своей очередью обновлений и рассылкой, только вместо порта слушает
+    сокет worker_socket(slot).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.processes = [None] * size
+        self.clients = []
+        self.supervisor = None
+        self.forwarded = collections.Counter()
+        self.unavailable = 0
+        self.restarts = 0
+
+    def spawn(self, slot):
+        path = worker_socket(slot)
+        if os.path.exists(path):
+            os.remove(path)
+        env = dict(os.environ, RUN_MODE="worker", WORKER_SLOT=str(slot))
+        self.processes[slot] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    async def start(self, timeout=60):
+        os.makedirs(WORKER_SOCKET_DIR, exist_ok=True)
+        for slot in range(self.size):
+            self.spawn(slot)
+        self.clients = [
+            httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=worker_socket(slot)),
+                base_url="http://worker",
+                timeout=30,
+            )
+            for slot in range(self.size)
+        ]
+        # uvicorn создаёт сокет после запуска приложения — тогда обработчик готов
+        deadline = time.monotonic() + timeout
+        while not all(os.path.exists(worker_socket(slot)) for slot in range(self.size)):
+            if time.monotonic() > deadline:
+                print(f"⚠️  Не все обработчики запустились за {timeout} сек")
+                break
+            await asyncio.sleep(0.1)
+        self.supervisor = asyncio.create_task(self.supervise())
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for slot, process in enumerate(self.processes):
+                if process.poll() is not None:
+                    print(f"⚠️  Обработчик {slot} завершился с кодом {process.returncode}, перезапускаем")
+                    self.restarts += 1
+                    self.spawn(slot)
+
+    async def forward(self, slot, body, headers):
+        """Пересылает обновление обработчику; его ответ (в том числе 503) уходит Telegram как есть"""
+        try:
+            response = await self.clients[slot].post("/webhook", content=body, headers=headers)
+        except httpx.HTTPError as e:
+            self.unavailable += 1
+            print(f"⚠️  Обработчик {slot} недоступен: {e}")
+            return JSONResponse({"ok": False, "error": f"Worker {slot} unavailable"}, status_code=503)
+        self.forwarded[slot] += 1
+        return Response(response.content, status_code=response.status_code, media_type="application/json")
+
+    async def get(self, slot, path):
+        try:
+            return (await self.clients[slot].get(path)).json()
+        except httpx.HTTPError as e:
+            return {"status": "error", "message": f"❌ Обработчик {slot} недоступен: {e}"}
+
+    async def stop(self, timeout):
+        """SIGTERM всем обработчикам: каждый дообрабатывает очередь и сохраняет данные"""
+        if self.supervisor:
+            self.supervisor.cancel()
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for slot, process in enumerate(self.processes):
+            try:
+                await asyncio.to_thread(process.wait, max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                print(f"⚠️  Обработчик {slot} не остановился за {timeout} сек")
+                process.kill()
+        for client in self.clients:
+            await client.aclose()
+
+    def stats(self):
+        return {
+            "workers": self.size,
+            "alive": sum(process is not None and process.poll() is None for process in self.processes),
+            "restarts": self.restarts,
+            "forwarded": dict(self.forwarded),
+            "unavailable": self.unavailable,
+        }
+
+worker_pool = WorkerPool(WORKERS)
+
+@asynccontextmanager
+async def front_lifespan(app: FastAPI):
+    print(f"🎅 Запуск обработчиков: {WORKERS}")
+    await worker_pool.start()
+    async with Bot(BOT_TOKEN, request=create_bot_request()) as bot:
+        await register_webhook(bot)
+    start_ping_loop()
+    print(f"✅ Тайный Санта готов: {worker_pool.stats()['alive']} обработчиков")
+    try:
+        yield
+    finally:
+        print("🎄 Остановка обработчиков...")
+        await worker_pool.stop(UPDATE_DRAIN_TIMEOUT + 20)
+        print("✅ Бот остановлен")
+
+# Процесс на PORT при WORKERS > 1: проверяет и распределяет обновления, данные не трогает
+front_app = FastAPI(lifespan=front_lifespan)
+front_app.get("/")(health_check)
+front_app.get("/ping")(ping_endpoint)
+
+@front_app.post("/webhook")
+async def front_webhook(req: Request):
+    if not is_authorized(req):
+        return JSONResponse({"ok": False, "error": "Forbidden"}, status_code=403)
+    body = await req.body()
+    try:
+        data = loads(body)
+    except ValueError:
+        webhook_stats["invalid"] += 1
+        return JSONResponse({"ok": False, "error": "Invalid JSON"}, status_code=400)
+    webhook_stats["received"] += 1
+    if not isinstance(data, dict) or not is_handled_update(data):
+        webhook_stats["filtered"] += 1
+        return {"ok": True}
+    headers = {"Content-Type": "application/json"}
+    if WEBHOOK_SECRET:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
+    return await worker_pool.forward(route_update(data), body, headers)
+
+@front_app.get("/metrics")
+async def front_metrics():
+    return {
+        "webhook": dict(webhook_stats),
+        "worker_pool": worker_pool.stats(),
+        "workers": {slot: await worker_pool.get(slot, "/metrics") for slot in range(WORKERS)},
+    }
+
+@front_app.get("/backup")
+async def front_backup():
+    # Бэкапы общей базы делает обработчик 0
+    return await worker_pool.get(0, "/backup")
+
+# ========== LONG POLLING ==========
+
+async def polling_loop():
+    """Забирает обновления getUpdates пачками и отдаёт их в ту же очередь, что и вебхук"""
+    offset = None
+    while True:
+        try:
+            updates = await application.bot.get_updates(
+                offset=offset,
+                limit=POLLING_BATCH,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        except NetworkError as e:
+            # TimedOut и обрывы соединения — повторяем, остальные ошибки Bot API не лечатся повтором
+            print(f"⚠️  Ошибка getUpdates: {e}")
+            await asyncio.sleep(POLLING_RETRY_DELAY)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            if seen_updates.is_duplicate(update.update_id):
+                continue
+            # Очередь заполнена — ждём места: следующую пачку заберём позже
+            await update_queue.put_wait(update)
+            seen_updates.add(update.update_id)
+
+async def run_polling():
+    started = time.monotonic()
+    async with lifespan(app):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            await polling_loop()
+        except asyncio.CancelledError:
+            pass  # SIGTERM — штатная остановка
+    elapsed = time.monotonic() - started
+    stats = update_queue.stats()
+    print(f"📈 Обработано обновлений: {stats['processed']} за {elapsed:.0f} сек "
+          f"({stats['processed'] / elapsed:.1f} в сек), среднее ожидание в очереди {stats['avg_wait']} сек")
+
 def main():
-    print(f"🎄 Запуск на порту {PORT}")
+    if RUN_MODE == "worker":
+        # Обновления обработчику пересылает процесс на PORT
+        uvicorn.run(app, uds=worker_socket(WORKER_SLOT))
+        return
+    if WORKERS > 1 and not SHARED_STORAGE:
+        print("⚠️  WORKERS > 1 работает только с RUN_MODE=webhook и STORAGE_BACKEND=sqlite, запускаем один процесс")
+    if RUN_MODE == "polling":
+        print("🎄 Запуск в режиме long polling")
+    else:
+        print(f"🎄 Запуск на порту {PORT}")
     print(f"📊 Пользователей в системе: {len(storage['users'])}")
     print(f"🎮 Игр в системе: {len(storage['games'])}")
     print(f"📚 FAQ канал: {FAQ_CHANNEL_LINK}")
-    print(f"💾 Файл данных: {STORAGE_FILE}")
-    print(f"💾 Файл бэкапа: {BACKUP_FILE}")
+    print(f"💾 Файл данных: {backend.path} (режим: {backend.name})")
+    print(f"💾 Файл бэкапа: {backend.backup_path}")
     
     try:
         test_file = "test_write.tmp"
@@ -1643,6 +3566,13 @@ def main():
         print(f"❌ Ошибка записи на диск: {e}")
         print("⚠️  Возможны проблемы с сохранением данных!")
     
+    if RUN_MODE == "polling":
+        try:
+            asyncio.run(run_polling())
+        except KeyboardInterrupt:
+            pass
+        return
+    
     print(f"📡 Система предотвращения сна:")
     print(f"   • Интервал пинга: {PING_INTERVAL} секунд")
     print(f"   • Эндпоинт для пинга: /ping")
@@ -1651,6 +3581,10 @@ def main():
     print("   • Cron-job: */5 * * * * curl -s https://ваш-домен/ping")
     print("   • UptimeRobot: мониторьте https://ваш-домен/")
     
+    if SHARED_STORAGE:
+        print(f"⚙️  Обработчиков: {WORKERS}, обновления распределяются по id пользователя")
+        uvicorn.run(front_app, host="0.0.0.0", port=PORT)
+        return
     uvicorn.run(app, host="0.0.0.0", port=PORT)
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+"""Модель данных бота: игры и пользователи.
+
+В памяти записи — компактные объекты со __slots__ и целыми id
+пользователей. На диск они уходят словарями прежнего формата (to_dict),
+поэтому бэкенды persistence.py и старые файлы данных не меняются.
+"""
+import copy
+
+
+class OrderedSet:
+    """Множество с порядком добавления: проверка, добавление и удаление за O(1)"""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items=()):
+        self.items = dict.fromkeys(items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return f"OrderedSet({list(self.items)!r})"
+
+    def add(self, item):
+        self.items[item] = None
+
+    def discard(self, item):
+        """Удаляет элемент; возвращает True, если он был"""
+        return self.items.pop(item, False) is None
+
+
+class Game:
+    """Игра: участники в порядке вступления, пары и пожелания по id участника"""
+
+    __slots__ = ("id", "name", "amount", "owner", "players", "started", "pairs", "wishes", "extra", "__weakref__")
+
+    FIELDS = ("id", "name", "amount", "owner", "players", "started", "pairs", "wishes")
+
+    def __init__(self, id, name, amount, owner, players=(), started=False, pairs=None, wishes=None, extra=None):
+        self.id = id
+        self.name = name
+        self.amount = amount
+        self.owner = owner
+        self.players = OrderedSet(players)
+        self.started = started
+        self.pairs = pairs or {}
+        self.wishes = wishes or {}
+        # Поля, о которых модель не знает, переживают загрузку и сохранение
+        self.extra = extra or {}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            id=data.get("id"),
+            name=data.get("name", "Без названия"),
+            amount=data.get("amount", 0),
+            owner=None if data.get("owner") is None else int(data["owner"]),
+            players=[int(uid) for uid in data.get("players", [])],
+            started=bool(data.get("started")),
+            pairs={int(giver): int(receiver) for giver, receiver in (data.get("pairs") or {}).items()},
+            wishes={int(uid): dict(wishes) for uid, wishes in (data.get("wishes") or {}).items()},
+            extra={key: value for key, value in data.items() if key not in cls.FIELDS},
+        )
+
+    def to_dict(self):
+        data = copy.deepcopy(self.extra)
+        data.update({
+            "id": self.id,
+            "name": self.name,
+            "amount": self.amount,
+            "owner": None if self.owner is None else str(self.owner),
+            "players": [str(uid) for uid in self.players],
+            "started": self.started,
+            "pairs": {str(giver): str(receiver) for giver, receiver in self.pairs.items()},
+            "wishes": {str(uid): dict(wishes) for uid, wishes in self.wishes.items()},
+        })
+        return data
+
+
+class Profile:
+    """Имя и username пользователя из последнего его обновления.
+
+    Атрибуты совпадают с telegram.User/Chat, поэтому профиль можно
+    передавать туда же, куда результат bot.get_chat.
+    """
+
+    __slots__ = ("first_name", "last_name", "username", "seen")
+
+    def __init__(self, first_name=None, last_name=None, username=None, seen=0):
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+        # Когда пользователь последний раз писал боту (unix time, с точностью до обновления снимка)
+        self.seen = seen
+
+    @classmethod
+    def from_telegram(cls, tg_user, seen):
+        return cls(tg_user.first_name, tg_user.last_name, tg_user.username, seen)
+
+    def matches(self, tg_user):
+        return (self.first_name, self.last_name, self.username) == (
+            tg_user.first_name, tg_user.last_name, tg_user.username
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("first_name"), data.get("last_name"), data.get("username"), data.get("seen", 0))
+
+    def to_dict(self):
+        return {
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "username": self.username,
+            "seen": self.seen,
+        }
+
+
+class User:
+    """Пользователь: его игры (в порядке вступления), настройки по играм и профиль"""
+
+    __slots__ = ("id", "games", "preferences", "profile", "unreachable", "extra", "__weakref__")
+
+    FIELDS = ("games", "preferences", "profile", "unreachable")
+
+    def __init__(self, id, games=(), preferences=None, profile=None, unreachable=None, extra=None):
+        self.id = id
+        self.games = OrderedSet(games)
+        self.preferences = preferences or {}
+        self.profile = profile
+        # {"reason": "blocked" | "deactivated" | "chat_not_found", "until": unix time} —
+        # Telegram отказал в доставке, до until писать пользователю бессмысленно
+        self.unreachable = unreachable
+        self.extra = extra or {}
+
+    def unreachable_reason(self, now):
+        """Причина недоступности, если отметка ещё действует"""
+        if self.unreachable and self.unreachable["until"] > now:
+            return self.unreachable["reason"]
+        return None
+
+    @classmethod
+    def from_dict(cls, uid, data):
+        return cls(
+            id=int(uid),
+            games=data.get("games") or [],
+            preferences=dict(data.get("preferences") or {}),
+            profile=Profile.from_dict(data["profile"]) if data.get("profile") else None,
+            unreachable=dict(data["unreachable"]) if data.get("unreachable") else None,
+            extra={key: value for key, value in data.items() if key not in cls.FIELDS},
+        )
+
+    def to_dict(self):
+        data = copy.deepcopy(self.extra)
+        data.update({
+            "games": list(self.games),
+            "preferences": copy.deepcopy(self.preferences),
+        })
+        if self.profile is not None:
+            data["profile"] = self.profile.to_dict()
+        if self.unreachable is not None:
+            data["unreachable"] = dict(self.unreachable)
+        return data
@@ -0,0 +1,1280 @@
+"""Хранение данных бота на диске.
+
+Модуль не зависит от telegram/fastapi, поэтому его можно использовать
+и из main.py, и из вспомогательных скриптов вроде check_storage.py.
+
+Изменения передаются в бэкенды «пачками» (batch):
+
+    {
+        "ops": ["join", ...],                # что произошло, для истории
+        "games": {game_id: game | None},     # None — игра удалена
+        "users": {user_id: user | None},
+        "outbox": {message_id: message | None},  # очередь исходящих сообщений
+        "meta": {...},                       # storage["_metadata"]
+    }
+"""
+import collections
+import collections.abc
+import concurrent.futures
+import fcntl
+import gzip
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COLLECTIONS = ("games", "users", "outbox")
+
+# Компактный снапшот: строка-заголовок с версией формата и CRC32, затем данные.
+# json-pretty — прежний человекочитаемый storage.json без заголовка.
+SNAPSHOT_MAGIC = b"SSNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FORMATS = ("json-pretty", "json", "msgpack")
+
+
+def empty_storage():
+    return {"games": {}, "users": {}, "outbox": {}, "_metadata": {"last_save": time.time(), "version": "1.0"}}
+
+
+def dumps_compact(value):
+    """Минифицированный JSON (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def encode_snapshot(data, fmt="json-pretty"):
+    if fmt == "json-pretty":
+        return json.dumps(data, ensure_ascii=False, indent=2, default=str).encode("utf-8")
+    if fmt == "msgpack":
+        payload = msgpack.packb(data, use_bin_type=True, default=str)
+    else:
+        payload = dumps_compact(data).encode("utf-8")
+    header = b"%s %d %s %08x\n" % (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, fmt.encode("ascii"), zlib.crc32(payload))
+    return header + payload
+
+
+def decode_snapshot(raw):
+    """Возвращает (data, verified): verified — контрольная сумма сошлась"""
+    if raw[:2] == b"\x1f\x8b":
+        raw = gzip.decompress(raw)
+    if not raw.startswith(SNAPSHOT_MAGIC):
+        return loads(raw), False
+    header, _, payload = raw.partition(b"\n")
+    _, version, fmt, checksum = header.decode("ascii").split(" ")
+    if int(version) > SNAPSHOT_VERSION:
+        raise ValueError(f"неизвестная версия снапшота {version}")
+    if zlib.crc32(payload) != int(checksum, 16):
+        raise ValueError("контрольная сумма снапшота не совпадает")
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("для чтения снапшота нужен пакет msgpack")
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False), True
+    return loads(payload), True
+
+
+def read_snapshot(path):
+    with open(path, "rb") as f:
+        return decode_snapshot(f.read())
+
+
+def resolve_format(fmt):
+    if fmt not in SNAPSHOT_FORMATS:
+        print(f"⚠️ Неизвестный формат снапшота {fmt}, используем json-pretty")
+        return "json-pretty"
+    if fmt == "msgpack" and msgpack is None:
+        print("⚠️ Пакет msgpack не установлен, снапшот будет в компактном JSON")
+        return "json"
+    return fmt
+
+
+def fsync_dir(path):
+    """Фиксирует на диске переименование внутри каталога"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, write):
+    """Пишет во временный файл, делает fsync и атомарно подменяет path.
+
+    При сбое посреди записи на месте остаётся прежняя версия файла.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path)
+
+
+def write_snapshot_file(path, data, fmt="json-pretty"):
+    payload = encode_snapshot(data, fmt)
+    atomic_write(path, lambda f: f.write(payload))
+
+
+def link_or_copy(src, dst):
+    """Делает dst жёсткой ссылкой на src (без копирования байтов), если ФС позволяет"""
+    tmp = f"{dst}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class BackupRotation:
+    """Поколения бэкапов: backup, backup.1.gz ... backup.N.gz.
+
+    Сдвиг поколений — только переименования; сжатие вышедшего из
+    оборота бэкапа выполняется в фоновом потоке.
+    """
+
+    def __init__(self, path, generations=5, interval=3600):
+        self.path = path
+        self.generations = generations
+        self.interval = interval
+        self.last_rotation = os.path.getmtime(path) if os.path.exists(path) else 0
+        self.lock = threading.Lock()
+
+    def generation_path(self, n, compressed=True):
+        return f"{self.path}.{n}.gz" if compressed else f"{self.path}.{n}"
+
+    def candidates(self):
+        """Все существующие бэкапы, от свежего к старому"""
+        paths = [self.path]
+        for n in range(1, self.generations + 1):
+            paths.append(self.generation_path(n, compressed=False))
+            paths.append(self.generation_path(n))
+        return [p for p in paths if os.path.exists(p)]
+
+    def due(self):
+        return time.time() - self.last_rotation >= self.interval
+
+    def rotate(self):
+        """Сдвигает поколения; текущий бэкап становится поколением 1"""
+        if not os.path.exists(self.path):
+            self.last_rotation = time.time()
+            return
+        with self.lock:
+            oldest = self.generation_path(self.generations)
+            if os.path.exists(oldest):
+                os.remove(oldest)
+            for n in range(self.generations - 1, 0, -1):
+                for compressed in (True, False):
+                    src = self.generation_path(n, compressed)
+                    if os.path.exists(src):
+                        os.replace(src, self.generation_path(n + 1, compressed))
+            if self.generations > 0:
+                os.replace(self.path, self.generation_path(1, compressed=False))
+            else:
+                os.remove(self.path)
+        self.last_rotation = time.time()
+        if self.generations > 0:
+            threading.Thread(target=self.compress_pending, daemon=True).start()
+
+    def compress_pending(self):
+        with self.lock:
+            for n in range(1, self.generations + 1):
+                src = self.generation_path(n, compressed=False)
+                if not os.path.exists(src):
+                    continue
+                dst = self.generation_path(n)
+                try:
+                    with open(src, "rb") as f_in, gzip.open(f"{dst}.tmp", "wb") as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+                    os.replace(f"{dst}.tmp", dst)
+                    os.remove(src)
+                except OSError as e:
+                    print(f"❌ Ошибка сжатия бэкапа {src}: {e}")
+
+
+def apply_batch(data, batch):
+    """Применяет пачку изменений к словарю storage (upsert/удаление записей)"""
+    for collection in COLLECTIONS:
+        records = data.setdefault(collection, {})
+        for key, value in batch.get(collection, {}).items():
+            if value is None:
+                records.pop(key, None)
+            else:
+                records[key] = value
+    if batch.get("meta"):
+        data["_metadata"] = batch["meta"]
+    return data
+
+
+class JsonBackend:
+    """Весь storage в одном файле-снапшоте; каждая запись перезаписывает файл целиком"""
+
+    name = "json"
+    # Для записи снапшота нужна полная копия данных в потоке сохранения
+    needs_mirror = True
+
+    def __init__(self, path, backup_path, backup_generations=5, backup_interval=3600, snapshot_format="json-pretty"):
+        self.path = path
+        self.backup_path = backup_path
+        self.rotation = BackupRotation(backup_path, backup_generations, backup_interval)
+        self.snapshot_format = resolve_format(snapshot_format)
+        # True, если последний load() прочитал снапшот с верной контрольной суммой
+        self.verified = False
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        data, self.verified = read_snapshot(self.path)
+        return data
+
+    def load_backup(self):
+        for path in self.rotation.candidates():
+            try:
+                data, _ = read_snapshot(path)
+            except Exception as e:
+                print(f"❌ Бэкап {path} не читается: {e}")
+                continue
+            print(f"📂 Используем бэкап {path}")
+            return data
+        return None
+
+    def backup(self, rotate=False):
+        """Текущий снапшот становится бэкапом через жёсткую ссылку.
+
+        Раз в backup_interval (или по rotate=True) прежний бэкап уходит
+        в старшие поколения.
+        """
+        if not os.path.exists(self.path):
+            return False
+        if rotate or self.rotation.due():
+            self.rotation.rotate()
+        link_or_copy(self.path, self.backup_path)
+        return True
+
+    def write_snapshot(self, data):
+        try:
+            self.backup()
+        except Exception as e:
+            print(f"Ошибка создания бэкапа: {e}")
+        write_snapshot_file(self.path, data, self.snapshot_format)
+
+    def write(self, data, batch):
+        self.write_snapshot(data)
+
+    def maintenance(self, data):
+        """Периодическая фоновая работа бэкенда (для JSON не нужна)"""
+
+
+class JournalBackend(JsonBackend):
+    """Снапшот storage.json плюс журнал изменений, дописываемый в конец.
+
+    Каждая запись журнала — одна строка JSON с актуальным содержимым
+    изменённых записей, поэтому повторное применение безопасно. Компактор
+    периодически сворачивает журнал в новый снапшот.
+    """
+
+    name = "journal"
+
+    def __init__(self, path, backup_path, journal_path, compact_bytes, compact_interval, **kwargs):
+        super().__init__(path, backup_path, **kwargs)
+        self.journal_path = journal_path
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        self.last_compact = time.time()
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.journal_path)
+
+    def load(self):
+        if os.path.exists(self.path):
+            data, self.verified = read_snapshot(self.path)
+        else:
+            data, self.verified = empty_storage(), True
+        replayed = self.replay(data)
+        if replayed:
+            print(f"📜 Из журнала применено записей: {replayed}")
+        return data
+
+    def load_backup(self):
+        # Бэкап — предыдущий снапшот; журнал после него ещё не свёрнут
+        data = super().load_backup()
+        if data is not None and isinstance(data, dict):
+            self.replay(data)
+        return data
+
+    def replay(self, data):
+        """Применяет журнал к data; оборванный сбоем хвост отрезается от файла.
+
+        Иначе следующие записи дописывались бы за обрывком без перевода
+        строки, и каждый перезапуск останавливался бы на нём, теряя всё
+        записанное после первого сбоя.
+        """
+        if not os.path.exists(self.journal_path):
+            return 0
+        count = 0
+        # Смещение конца последней целой записи
+        good = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    try:
+                        batch = loads(line)
+                    except ValueError:
+                        break
+                    apply_batch(data, batch)
+                    count += 1
+                good += len(line)
+            size = f.seek(0, os.SEEK_END)
+        if good < size:
+            print(f"⚠️ Отброшен повреждённый хвост журнала: {size - good} байт")
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good)
+                f.flush()
+                os.fsync(f.fileno())
+        return count
+
+    def write(self, data, batch):
+        line = dumps_compact(batch)
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def maintenance(self, data):
+        size = self.journal_size()
+        if not size:
+            return
+        if size >= self.compact_bytes or time.time() - self.last_compact >= self.compact_interval:
+            self.compact(data)
+
+    def compact(self, data):
+        """Записывает свежий снапшот и очищает журнал"""
+        self.write_snapshot(data)
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        self.last_compact = time.time()
+        print("🗜️ Журнал свёрнут в снапшот")
+
+
+def shard_of(key, shard_count):
+    """Номер шарда записи; crc32 стабилен между запусками, в отличие от hash()"""
+    return zlib.crc32(str(key).encode("utf-8")) % shard_count
+
+
+def read_sharded(path):
+    """Читает каталог шардов целиком; возвращает (data, verified)"""
+    manifest, _ = read_snapshot(os.path.join(path, "manifest.json"))
+    data = empty_storage()
+    verified = True
+    for collection in COLLECTIONS:
+        for i in range(manifest["shards"]):
+            shard_path = os.path.join(path, f"{collection}-{i:03d}.json")
+            if not os.path.exists(shard_path):
+                continue
+            records, shard_verified = read_snapshot(shard_path)
+            data[collection].update(records)
+            verified = verified and shard_verified
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        data["_metadata"], _ = read_snapshot(meta_path)
+    pending_path = os.path.join(path, "pending.json")
+    if os.path.exists(pending_path):
+        # Пачка, запись которой оборвалась посреди шардов: дописываем её
+        try:
+            with open(pending_path, "rb") as f:
+                apply_batch(data, loads(f.read()))
+            print("📜 Применена незавершённая пачка изменений")
+        except ValueError:
+            print("⚠️ Пропущена повреждённая незавершённая пачка")
+    return data, verified
+
+
+class ShardedBackend(JsonBackend):
+    """Записи разложены по shard_count файлам в каталоге path.
+
+    Игра и пользователь попадают в шард по crc32 своего id; пачка
+    перезаписывает только шарды, в которых есть изменённые записи. Перед
+    записью нескольких шардов пачка сохраняется в pending.json, поэтому
+    после сбоя посреди записи она будет применена при загрузке.
+    """
+
+    name = "sharded"
+    # Копию данных бэкенд держит сам, разложенной по шардам; она читается с диска при первой записи
+    needs_mirror = False
+
+    def __init__(self, path, backup_path, shard_count=16, **kwargs):
+        super().__init__(path, backup_path, **kwargs)
+        self.shard_count = shard_count
+        # {collection: [{key: record}, ...]} — копия данных, разложенная по шардам
+        self.shards = None
+        self.resharded = False
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def shard_path(self, collection, i):
+        return self.file(f"{collection}-{i:03d}.json")
+
+    def exists(self):
+        return os.path.exists(self.file("manifest.json"))
+
+    def load(self):
+        recovered = os.path.exists(self.file("pending.json"))
+        data, self.verified = read_sharded(self.path)
+        manifest, _ = read_snapshot(self.file("manifest.json"))
+        if manifest["shards"] != self.shard_count:
+            print(f"🔀 Число шардов меняется: {manifest['shards']} → {self.shard_count}")
+            self.resharded = True
+        if recovered:
+            # Незавершённая пачка должна попасть в шарды, иначе при следующей загрузке
+            # она снова легла бы поверх более новых записей
+            self.write_snapshot(data)
+            # data дальше меняет бот; копия в шардах прочитается с диска при первой записи
+            self.shards = None
+        return data
+
+    def partition(self, data):
+        self.shards = {collection: [{} for _ in range(self.shard_count)] for collection in COLLECTIONS}
+        for collection in COLLECTIONS:
+            for key, record in data.get(collection, {}).items():
+                self.shards[collection][shard_of(key, self.shard_count)][key] = record
+
+    def write_shard(self, collection, i):
+        write_snapshot_file(self.shard_path(collection, i), self.shards[collection][i], self.snapshot_format)
+
+    def write_meta(self, meta):
+        write_snapshot_file(self.file("meta.json"), meta, self.snapshot_format)
+
+    def write_snapshot(self, data):
+        """Полная перезапись всех шардов (перенос, смена числа шардов)"""
+        os.makedirs(self.path, exist_ok=True)
+        self.partition(data)
+        for collection in COLLECTIONS:
+            for i in range(self.shard_count):
+                self.write_shard(collection, i)
+        self.write_meta(data.get("_metadata", {}))
+        write_snapshot_file(self.file("manifest.json"), {"version": 1, "shards": self.shard_count})
+        # Шарды прежней раскладки больше не нужны
+        for name in os.listdir(self.path):
+            stem, _, number = name.partition("-")
+            if stem in COLLECTIONS and int(number.split(".")[0]) >= self.shard_count:
+                os.remove(self.file(name))
+        self.remove_pending()
+        self.resharded = False
+
+    def remove_pending(self):
+        try:
+            os.remove(self.file("pending.json"))
+        except FileNotFoundError:
+            pass
+
+    def write(self, data, batch):
+        # data не передаётся (needs_mirror = False): всё, что не в пачке, берётся из шардов на диске
+        if self.resharded or not self.exists():
+            data = read_sharded(self.path)[0] if self.exists() else empty_storage()
+            self.write_snapshot(apply_batch(data, batch))
+            return
+        if self.shards is None:
+            self.partition(read_sharded(self.path)[0])
+        touched = set()
+        for collection in COLLECTIONS:
+            for key, record in batch.get(collection, {}).items():
+                i = shard_of(key, self.shard_count)
+                if record is None:
+                    self.shards[collection][i].pop(key, None)
+                else:
+                    self.shards[collection][i][key] = record
+                touched.add((collection, i))
+        pending = self.file("pending.json")
+        if len(touched) > 1:
+            payload = dumps_compact(batch).encode("utf-8")
+            atomic_write(pending, lambda f: f.write(payload))
+        for collection, i in sorted(touched):
+            self.write_shard(collection, i)
+        if batch.get("meta"):
+            self.write_meta(batch["meta"])
+        # Шарды записаны — пачка, в том числе оставшаяся от прежнего сбоя, больше не нужна
+        self.remove_pending()
+
+    def backup(self, rotate=False):
+        """Бэкап — один снапшот со всеми записями (читается как обычный storage.json)"""
+        if self.shards is None:
+            if not self.exists():
+                return False
+            data, _ = read_sharded(self.path)
+        else:
+            data = {collection: {} for collection in COLLECTIONS}
+            for collection in COLLECTIONS:
+                for shard in self.shards[collection]:
+                    data[collection].update(shard)
+            data["_metadata"], _ = read_snapshot(self.file("meta.json"))
+        if rotate or self.rotation.due():
+            self.rotation.rotate()
+        write_snapshot_file(self.backup_path, data, self.snapshot_format)
+        return True
+
+    def maintenance(self, data):
+        if self.rotation.due():
+            self.backup()
+
+
+class PersistenceWorker:
+    """Поток сохранения: кодирование и файловый ввод-вывод вне event loop.
+
+    Задачи выполняются строго по очереди. Поток держит собственную копию
+    данных (mirror) для бэкендов, которым нужен полный снапшот; в неё
+    применяются приходящие пачки, поэтому в event loop копируются только
+    изменённые записи.
+    """
+
+    def __init__(self, backend, mirror=None):
+        self.backend = backend
+        self.data = mirror
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="persistence", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            fn, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+    def call(self, fn):
+        """Выполняет fn в потоке сохранения; возвращает concurrent.futures.Future"""
+        future = concurrent.futures.Future()
+        self.jobs.put((fn, future))
+        return future
+
+    def submit(self, batch):
+        def write():
+            if self.data is not None:
+                apply_batch(self.data, batch)
+            self.backend.write(self.data, batch)
+            return batch
+        return self.call(write)
+
+    def maintenance(self):
+        return self.call(lambda: self.backend.maintenance(self.data))
+
+    def stop(self, timeout=30):
+        self.jobs.put(None)
+        self.thread.join(timeout)
+
+
+class LazyRecords(collections.abc.MutableMapping):
+    """Горячий LRU-кэш записей поверх хранилища на диске.
+
+    Промах загружает запись через load_one(key); записи должны
+    поддерживать weakref. Лишние записи вытесняет
+    trim() — его зовут между пачками сохранения, когда все изменения уже
+    помечены, поэтому обработчик не теряет правки записи, вытесненной у
+    него из-под рук. Вытесненная запись, на которую ещё есть ссылки,
+    находится через weakref: у одного ключа не бывает двух разных объектов.
+
+    Изменённые, но ещё не записанные на диск записи закрепляются (pin) и не
+    вытесняются; удалённые до записи помнятся как None.
+    """
+
+    def __init__(self, load_one, count, capacity):
+        self.load_one = load_one
+        self.count = count
+        self.capacity = capacity
+        self.hot = collections.OrderedDict()
+        self.alive = weakref.WeakValueDictionary()
+        self.pinned = {}
+        self.pins = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def remember(self, key, record):
+        self.hot[key] = record
+        self.hot.move_to_end(key)
+        self.alive[key] = record
+
+    def trim(self):
+        """Вытесняет давно не использованные записи сверх capacity"""
+        evicted = 0
+        while len(self.hot) > self.capacity:
+            self.hot.popitem(last=False)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def get(self, key, default=None):
+        if key in self.pinned:
+            record = self.pinned[key]
+            if record is None:
+                return default
+            self.hits += 1
+            self.remember(key, record)
+            return record
+        record = self.hot.get(key)
+        if record is None:
+            record = self.alive.get(key)
+        if record is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            record = self.load_one(key)
+            if record is None:
+                return default
+        self.remember(key, record)
+        return record
+
+    def __getitem__(self, key):
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, record):
+        if key in self.pinned:
+            self.pinned[key] = record
+        self.remember(key, record)
+
+    def __delitem__(self, key):
+        if self.get(key) is None:
+            raise KeyError(key)
+        self.hot.pop(key, None)
+        self.alive.pop(key, None)
+        # Пока удаление не записано, с диска запись читать нельзя
+        self.pinned[key] = None
+
+    def __len__(self):
+        """Число записей на диске (без ещё не сохранённых изменений)"""
+        return self.count()
+
+    def __iter__(self):
+        raise TypeError("LazyRecords не поддерживает полный обход — используйте запросы бэкенда")
+
+    def invalidate(self, key):
+        """Забывает запись, изменённую другим процессом: следующий get() прочитает её с диска.
+
+        Запись с несохранёнными изменениями этого процесса остаётся — её
+        версия новее той, что на диске. Возвращает True, если запись забыта.
+        """
+        if key in self.pinned:
+            return False
+        self.hot.pop(key, None)
+        self.alive.pop(key, None)
+        self.invalidations += 1
+        return True
+
+    def pin(self, key):
+        """Не вытеснять запись, пока её изменения не записаны"""
+        if key not in self.pinned:
+            self.pinned[key] = self.get(key)
+        self.pins[key] += 1
+
+    def unpin(self, key):
+        self.pins[key] -= 1
+        if self.pins[key] <= 0:
+            del self.pins[key]
+            self.pinned.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "resident": len(self.hot),
+            "capacity": self.capacity,
+            "pinned": len(self.pinned),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+class StripedFileLocks:
+    """Блокировки записей между процессами: flock на файлах каталога path.
+
+    Ключ попадает в одну из stripes полос своего пространства имён
+    (shard_of — одинаково во всех процессах), полоса — отдельный файл.
+    flock принадлежит открытому файлу, а не корутине, поэтому внутри
+    процесса полосу дополнительно охраняет вызывающий код.
+    """
+
+    def __init__(self, path, stripes=256):
+        self.path = path
+        self.stripes = stripes
+        self.files = {}
+        self.acquired = 0
+        self.busy = 0
+        os.makedirs(path, exist_ok=True)
+
+    def stripe(self, namespace, key):
+        return namespace, shard_of(key, self.stripes)
+
+    def fd(self, stripe):
+        fd = self.files.get(stripe)
+        if fd is None:
+            namespace, i = stripe
+            fd = self.files[stripe] = os.open(
+                os.path.join(self.path, f"{namespace}-{i:03d}.lock"), os.O_RDWR | os.O_CREAT, 0o644
+            )
+        return fd
+
+    def try_acquire(self, stripe):
+        """Неблокирующая попытка; False — полосу держит другой процесс"""
+        try:
+            fcntl.flock(self.fd(stripe), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.busy += 1
+            return False
+        self.acquired += 1
+        return True
+
+    def release(self, stripe):
+        fcntl.flock(self.fd(stripe), fcntl.LOCK_UN)
+
+    def stats(self):
+        return {"stripes": self.stripes, "acquired": self.acquired, "busy": self.busy}
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    amount TEXT,
+    owner TEXT,
+    started INTEGER NOT NULL DEFAULT 0,
+    pairs TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS games_owner ON games(owner);
+CREATE INDEX IF NOT EXISTS games_started ON games(started);
+
+CREATE TABLE IF NOT EXISTS members (
+    game_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (game_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS members_user ON members(user_id);
+
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    state TEXT,
+    tmp_name TEXT,
+    tmp_game_id TEXT,
+    games TEXT,
+    preferences TEXT,
+    extra TEXT
+);
+
+CREATE TABLE IF NOT EXISTS wishes (
+    game_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    wish TEXT,
+    not_wish TEXT,
+    PRIMARY KEY (game_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_status ON outbox(status);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection TEXT NOT NULL,
+    key TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    at REAL NOT NULL
+);
+"""
+
+GAME_COLUMNS = ("id", "name", "amount", "owner", "started", "pairs", "players", "wishes")
+USER_COLUMNS = ("state", "tmp_name", "tmp_game_id", "games", "preferences", "wishes")
+
+
+_dumps = dumps_compact
+
+
+def _extra(record, columns):
+    extra = {k: v for k, v in record.items() if k not in columns}
+    return _dumps(extra) if extra else None
+
+
+class SqliteBackend:
+    """Игры, участники, пожелания и состояния пользователей в SQLite (WAL).
+
+    Каждая пачка изменений — одна транзакция, затрагивающая только
+    изменённые строки.
+
+    Базу могут делить несколько процессов. Тогда у каждого свой origin:
+    вместе с пачкой в таблицу changes пишутся id изменённых игр и
+    пользователей, и остальные процессы по changes_since() узнают, какие
+    записи в их памяти устарели.
+    """
+
+    name = "sqlite"
+    needs_mirror = False
+    # Структуру записей гарантирует схема таблиц
+    verified = True
+
+    def __init__(self, path, backup_path, backup_generations=5, backup_interval=3600,
+                 origin=None, change_retention=3600):
+        self.path = path
+        self.backup_path = backup_path
+        self.rotation = BackupRotation(backup_path, backup_generations, backup_interval)
+        self.origin = origin
+        self.change_retention = change_retention
+        self.pruned_at = 0
+        self.lock = threading.Lock()
+        self.conn = self.connect(path)
+        # Отдельное соединение для чтений из event loop: в WAL читатели не ждут писателя
+        self.reader = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+
+    @staticmethod
+    def connect(path):
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLITE_SCHEMA)
+        return conn
+
+    def exists(self):
+        row = self.conn.execute(
+            "SELECT (SELECT COUNT(*) FROM games) + (SELECT COUNT(*) FROM users) + (SELECT COUNT(*) FROM meta)"
+            " + (SELECT COUNT(*) FROM outbox)"
+        ).fetchone()
+        return row[0] > 0
+
+    def load(self):
+        with self.lock:
+            return self.read_all(self.conn)
+
+    def load_backup(self):
+        for path in self.rotation.candidates():
+            try:
+                data = self.read_backup(path)
+            except Exception as e:
+                print(f"❌ Бэкап {path} не читается: {e}")
+                continue
+            print(f"📂 Используем бэкап {path}")
+            return data
+        return None
+
+    def read_backup(self, path):
+        """Читает копию базы; сжатое поколение сначала распаковывается во временный файл"""
+        restore = None
+        if path.endswith(".gz"):
+            restore = f"{self.backup_path}.restore"
+            with gzip.open(path, "rb") as f_in, open(restore, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            path = restore
+        conn = sqlite3.connect(path)
+        try:
+            return self.read_all(conn)
+        finally:
+            conn.close()
+            if restore is not None:
+                os.remove(restore)
+
+    @classmethod
+    def read_all(cls, conn):
+        data = {"games": {}, "users": {}, "outbox": {}, "_metadata": {}}
+        for row in conn.execute("SELECT id, name, amount, owner, started, pairs, extra FROM games"):
+            game = cls.game_from_row(row)
+            data["games"][game["id"]] = game
+        for game_id, user_id in conn.execute("SELECT game_id, user_id FROM members ORDER BY game_id, position"):
+            if game_id in data["games"]:
+                data["games"][game_id]["players"].append(user_id)
+        for game_id, user_id, wish, not_wish in conn.execute("SELECT game_id, user_id, wish, not_wish FROM wishes"):
+            if game_id in data["games"]:
+                data["games"][game_id]["wishes"][user_id] = {"wish": wish, "not_wish": not_wish}
+        for row in conn.execute("SELECT id, state, tmp_name, tmp_game_id, games, preferences, extra FROM users"):
+            data["users"][row[0]] = cls.user_from_row(row)
+        for message_id, message in conn.execute("SELECT id, data FROM outbox"):
+            data["outbox"][message_id] = loads(message)
+        row = conn.execute("SELECT value FROM meta WHERE key = 'metadata'").fetchone()
+        if row:
+            data["_metadata"] = loads(row[0])
+        return data
+
+    @staticmethod
+    def game_from_row(row):
+        game_id, name, amount, owner, started, pairs, extra = row
+        game = loads(extra) if extra else {}
+        game.update({
+            "id": game_id,
+            "name": name,
+            "amount": amount,
+            "owner": owner,
+            "players": [],
+            "started": bool(started),
+            "pairs": loads(pairs) if pairs else {},
+            "wishes": {},
+        })
+        return game
+
+    @staticmethod
+    def user_from_row(row):
+        # state/tmp_name/tmp_game_id остались в схеме от прежних версий, бот их больше не хранит
+        _, _, _, _, games, preferences, extra = row
+        user = loads(extra) if extra else {}
+        user.update({
+            "games": loads(games) if games else [],
+            "preferences": loads(preferences) if preferences else {},
+        })
+        return user
+
+    def put_game(self, game_id, game):
+        self.conn.execute("DELETE FROM members WHERE game_id = ?", (game_id,))
+        self.conn.execute("DELETE FROM wishes WHERE game_id = ?", (game_id,))
+        if game is None:
+            self.conn.execute("DELETE FROM games WHERE id = ?", (game_id,))
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO games (id, name, amount, owner, started, pairs, extra) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                game_id,
+                game.get("name"),
+                None if game.get("amount") is None else str(game["amount"]),
+                None if game.get("owner") is None else str(game["owner"]),
+                1 if game.get("started") else 0,
+                _dumps(game.get("pairs") or {}),
+                _extra(game, GAME_COLUMNS),
+            ),
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO members (game_id, user_id, position) VALUES (?, ?, ?)",
+            [(game_id, str(uid), i) for i, uid in enumerate(game.get("players", []))],
+        )
+        self.conn.executemany(
+            "INSERT INTO wishes (game_id, user_id, wish, not_wish) VALUES (?, ?, ?, ?)",
+            [
+                (game_id, str(uid), wishes.get("wish"), wishes.get("not_wish"))
+                for uid, wishes in game.get("wishes", {}).items()
+            ],
+        )
+
+    def put_user(self, user_id, user):
+        if user is None:
+            self.conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO users (id, state, tmp_name, tmp_game_id, games, preferences, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                user_id,
+                user.get("state"),
+                user.get("tmp_name"),
+                user.get("tmp_game_id"),
+                _dumps(user.get("games", [])),
+                _dumps(user.get("preferences", {})),
+                _extra(user, USER_COLUMNS),
+            ),
+        )
+
+    def put_outbox(self, message_id, message):
+        if message is None:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO outbox (id, status, data) VALUES (?, ?, ?)",
+            (message_id, message.get("status"), _dumps(message)),
+        )
+
+    def put_meta(self, meta):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('metadata', ?)", (_dumps(meta),))
+
+    def put_changes(self, batch):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO changes (collection, key, origin, at) VALUES (?, ?, ?, ?)",
+            [
+                (collection, str(key), self.origin, now)
+                for collection in ("games", "users")
+                for key in batch.get(collection, {})
+            ],
+        )
+
+    def write(self, data, batch):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for game_id, game in batch.get("games", {}).items():
+                    self.put_game(game_id, game)
+                for user_id, user in batch.get("users", {}).items():
+                    self.put_user(user_id, user)
+                for message_id, message in batch.get("outbox", {}).items():
+                    self.put_outbox(message_id, message)
+                if batch.get("meta"):
+                    self.put_meta(batch["meta"])
+                if self.origin is not None:
+                    self.put_changes(batch)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def write_snapshot(self, data):
+        """Полная перезапись базы содержимым data"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in ("games", "members", "users", "wishes", "outbox"):
+                    self.conn.execute(f"DELETE FROM {table}")
+                for game_id, game in data.get("games", {}).items():
+                    self.put_game(game_id, game)
+                for user_id, user in data.get("users", {}).items():
+                    self.put_user(user_id, user)
+                for message_id, message in data.get("outbox", {}).items():
+                    self.put_outbox(message_id, message)
+                self.put_meta(data.get("_metadata", {}))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def backup(self, rotate=False):
+        """Онлайн-копия базы во временный файл с атомарной подменой бэкапа"""
+        if rotate or self.rotation.due():
+            self.rotation.rotate()
+        tmp = f"{self.backup_path}.tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        dst = sqlite3.connect(tmp)
+        try:
+            with self.lock:
+                self.conn.backup(dst)
+        finally:
+            dst.close()
+        os.replace(tmp, self.backup_path)
+        fsync_dir(self.backup_path)
+        return True
+
+    def maintenance(self, data):
+        """Периодический бэкап; WAL SQLite сбрасывает в основной файл сам"""
+        if self.rotation.due():
+            self.backup()
+        if self.origin is not None and time.time() - self.pruned_at > 60:
+            self.pruned_at = time.time()
+            with self.lock:
+                self.conn.execute("DELETE FROM changes WHERE at < ?", (self.pruned_at - self.change_retention,))
+
+    def last_change(self):
+        """Номер последнего изменения; с него процесс начинает следить за чужими записями"""
+        return self.reader.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def changes_since(self, seq):
+        """[(seq, collection, key)] — изменения других процессов после seq"""
+        return self.reader.execute(
+            "SELECT seq, collection, key FROM changes WHERE seq > ? AND origin != ? ORDER BY seq",
+            (seq, self.origin),
+        ).fetchall()
+
+    def user_active_games(self, user_id):
+        """Id незавершённых игр пользователя (по индексу участников)"""
+        rows = self.reader.execute(
+            "SELECT g.id FROM members m JOIN games g ON g.id = m.game_id "
+            "WHERE m.user_id = ? AND g.started = 0",
+            (str(user_id),),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def started_game_ids(self):
+        return [row[0] for row in self.reader.execute("SELECT id FROM games WHERE started = 1")]
+
+    def load_game(self, game_id):
+        """Одна игра с участниками и пожеланиями — запросы по первичным ключам"""
+        self.reader.execute("BEGIN")
+        try:
+            row = self.reader.execute(
+                "SELECT id, name, amount, owner, started, pairs, extra FROM games WHERE id = ?", (game_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            game = self.game_from_row(row)
+            game["players"] = [uid for (uid,) in self.reader.execute(
+                "SELECT user_id FROM members WHERE game_id = ? ORDER BY position", (game_id,)
+            )]
+            for uid, wish, not_wish in self.reader.execute(
+                "SELECT user_id, wish, not_wish FROM wishes WHERE game_id = ?", (game_id,)
+            ):
+                game["wishes"][uid] = {"wish": wish, "not_wish": not_wish}
+            return game
+        finally:
+            self.reader.execute("COMMIT")
+
+    def load_user(self, user_id):
+        row = self.reader.execute(
+            "SELECT id, state, tmp_name, tmp_game_id, games, preferences, extra FROM users WHERE id = ?", (user_id,)
+        ).fetchone()
+        return self.user_from_row(row) if row else None
+
+    def load_outbox(self, worker=None):
+        """Очередь сообщений невелика и всегда загружается целиком.
+
+        worker — загрузить только сообщения этого процесса; сообщения без
+        отметки (записанные одним процессом) достаются процессу 0.
+        """
+        outbox = {}
+        for message_id, raw in self.reader.execute("SELECT id, data FROM outbox"):
+            message = loads(raw)
+            if worker is None or message.get("worker", 0) == worker:
+                outbox[message_id] = message
+        return outbox
+
+    def load_meta(self):
+        row = self.reader.execute("SELECT value FROM meta WHERE key = 'metadata'").fetchone()
+        return loads(row[0]) if row else {}
+
+    def count(self, table):
+        return self.reader.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def counts(self):
+        finished = self.reader.execute("SELECT COUNT(*) FROM games WHERE started = 1").fetchone()[0]
+        games = self.count("games")
+        return {
+            "games": games,
+            "active_games": games - finished,
+            "finished_games": finished,
+            "users": self.count("users"),
+            "users_with_games": self.reader.execute("SELECT COUNT(DISTINCT user_id) FROM members").fetchone()[0],
+        }
+
+
+def drop_invalid_games(data):
+    """Убирает игры, которые бот не прочитает (не словарь или без players); возвращает их id"""
+    games = data.get("games", {})
+    invalid = [game_id for game_id, game in games.items() if not isinstance(game, dict) or "players" not in game]
+    for game_id in invalid:
+        print(f"❌ Удаляем некорректную игру: {game_id}")
+        del games[game_id]
+    return invalid
+
+
+def move_wishes_to_games(data):
+    """Пожелания раньше лежали в users[uid]["wishes"][game_id]; теперь — в games[game_id]["wishes"][uid].
+
+    Возвращает (games, users) — id записей, которые изменились и должны
+    быть переписаны на диске.
+    """
+    games, users = set(), set()
+    moved = 0
+    for uid, user in data.get("users", {}).items():
+        if not isinstance(user, dict) or "wishes" not in user:
+            continue
+        users.add(uid)
+        for game_id, wishes in user.pop("wishes").items():
+            game = data.get("games", {}).get(game_id)
+            if isinstance(game, dict):
+                game.setdefault("wishes", {})[uid] = wishes
+                games.add(game_id)
+                moved += 1
+    if moved:
+        print(f"🔄 Пожелания перенесены в игры: {moved}")
+    return games, users
+
+
+def migrate_json_to_sqlite(json_path, db_path):
+    """Одноразовый перенос storage.json в SQLite"""
+    data, _ = read_snapshot(json_path)
+    # SQLite и шарды с контрольными суммами при загрузке уже не проверяются
+    drop_invalid_games(data)
+    move_wishes_to_games(data)
+    target = SqliteBackend(db_path, db_path + ".bak")
+    target.write_snapshot(data)
+    print(f"✅ Перенесено в {db_path}: {len(data.get('games', {}))} игр, {len(data.get('users', {}))} пользователей")
+    return target
+
+
+def migrate_json_to_sharded(json_path, shard_dir, shard_count=16):
+    """Раскладывает storage.json по шардам"""
+    data, _ = read_snapshot(json_path)
+    # SQLite и шарды с контрольными суммами при загрузке уже не проверяются
+    drop_invalid_games(data)
+    move_wishes_to_games(data)
+    target = ShardedBackend(shard_dir, json_path + ".bak", shard_count=shard_count)
+    target.write_snapshot(data)
+    print(f"✅ Разложено в {shard_dir}: {shard_count} шардов, {len(data.get('games', {}))} игр, "
+          f"{len(data.get('users', {}))} пользователей")
+    return target
+
+
+def convert_snapshot(src, dst, fmt="json-pretty"):
+    """Перекодирует снапшот в другой формат (в обе стороны)"""
+    data, verified = read_snapshot(src)
+    write_snapshot_file(dst, data, resolve_format(fmt))
+    status = "контрольная сумма ✅" if verified else "без контрольной суммы"
+    print(f"✅ {src} → {dst} ({fmt}, исходник: {status})")
+
+
+USAGE = """Использование:
+  python persistence.py migrate-sqlite storage.json storage.db
+  python persistence.py migrate-sharded storage.json storage_shards [N]
+  python persistence.py convert SRC DST [json-pretty|json|msgpack]"""
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "migrate-sqlite":
+        migrate_json_to_sqlite(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == "migrate-sharded":
+        migrate_json_to_sharded(sys.argv[2], sys.argv[3], *map(int, sys.argv[4:]))
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == "convert":
+        convert_snapshot(*sys.argv[2:])
+    else:
+        print(USAGE)
+        sys.exit(1)
@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persistence import JournalBackend
+
+
+def game_batch(game_id, version):
+    return {"ops": ["edit"], "games": {game_id: {"id": game_id, "version": version}}}
+
+
+class JournalRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def backend(self):
+        path = os.path.join(self.dir.name, "storage.json")
+        return JournalBackend(
+            path,
+            path + ".bak",
+            os.path.join(self.dir.name, "storage.journal"),
+            compact_bytes=1 << 30,
+            compact_interval=3600,
+        )
+
+    def test_torn_tail_is_truncated_and_later_records_survive(self):
+        backend = self.backend()
+        data = backend.load()
+        backend.write(data, game_batch("g1", 1))
+        backend.write(data, game_batch("g2", 1))
+        # Сбой посреди дописывания: строка без перевода строки и недописанный JSON
+        with open(backend.journal_path, "a", encoding="utf-8") as f:
+            f.write('{"ops":["edit"],"games":{"g9"')
+
+        # Первый перезапуск: обрывок отрезан, дальше журнал пишется с чистой строки
+        backend = self.backend()
+        data = backend.load()
+        self.assertEqual(set(data["games"]), {"g1", "g2"})
+        backend.write(data, game_batch("g3", 1))
+        backend.write(data, game_batch("g1", 2))
+
+        # Второй перезапуск видит всё, что записано после сбоя
+        data = self.backend().load()
+        self.assertEqual(set(data["games"]), {"g1", "g2", "g3"})
+        self.assertEqual(data["games"]["g1"]["version"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
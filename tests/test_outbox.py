@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main при импорте создаёт хранилище в текущем каталоге
+os.environ.setdefault("BOT_TOKEN", "1:test")
+workdir = tempfile.TemporaryDirectory()
+os.chdir(workdir.name)
+
+from telegram.error import NetworkError
+
+import main
+
+
+class FakeBot:
+    """Записывает отправленные сообщения; первые failures отправок падают с NetworkError"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise NetworkError("connection reset")
+        self.sent.append((chat_id, text))
+
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        main.storage["outbox"].clear()
+        main.outbox_pending.clear()
+        main.outbox_unsaved.clear()
+        main.outbox_wakeup = asyncio.Event()
+
+    def enqueue(self, chat_id, text):
+        message_id = main.enqueue_message(chat_id, text)
+        # Пачку с сообщением считаем записанной
+        main.release_saved_messages([message_id])
+        return main.storage["outbox"][message_id]
+
+    async def test_messages_to_one_chat_keep_order(self):
+        for i in range(3):
+            self.enqueue(1, f"first-{i}")
+        self.enqueue(2, "second")
+        bot = FakeBot()
+        await main.drain_outbox(bot, asyncio.Semaphore(10))
+        self.assertEqual([text for chat_id, text in bot.sent if chat_id == 1], ["first-0", "first-1", "first-2"])
+        self.assertIn((2, "second"), bot.sent)
+        self.assertFalse(main.outbox_pending)
+
+    async def test_deferred_message_holds_back_later_ones(self):
+        first = self.enqueue(1, "first")
+        self.enqueue(1, "second")
+        bot = FakeBot(failures=1)
+        await main.drain_outbox(bot, asyncio.Semaphore(10))
+        self.assertEqual(bot.sent, [])
+        self.assertEqual(first["attempts"], 1)
+        self.assertGreater(first["next_at"], time.time())
+        # Срок второго сообщения уже наступил, но будить цикл раньше первого незачем
+        self.assertEqual(main.outbox_next_at(), first["next_at"])
+
+    async def test_loop_sleeps_until_deferred_message_is_due(self):
+        self.enqueue(1, "first")
+        self.enqueue(1, "second")
+        passes = 0
+        drain_outbox = main.drain_outbox
+
+        async def counting_drain(bot, semaphore):
+            nonlocal passes
+            passes += 1
+            await drain_outbox(bot, semaphore)
+
+        main.drain_outbox = counting_drain
+        self.addCleanup(setattr, main, "drain_outbox", drain_outbox)
+        bot = FakeBot(failures=1)
+        task = asyncio.create_task(main.outbox_loop(bot))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        self.assertEqual(passes, 1)
+        self.assertEqual(bot.sent, [])
+
+
+if __name__ == "__main__":
+    unittest.main()